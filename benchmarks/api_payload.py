@@ -0,0 +1,80 @@
+"""Compare payload size and response time of the HTML pages with the JSON API.
+
+Seeds a throwaway SQLite database and requests the same feed page and
+comment thread as HTML, as API JSON and (if msgpack is installed) as API
+msgpack through the Flask test client, e.g.:
+
+    python benchmarks/api_payload.py --posts 500 --comments 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed
+
+
+def measure(client, path, headers, repeat, marker):
+    """Return (body size, median seconds, items in the body) for one URL."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(path, headers=headers)
+        body = response.get_data()
+        response.close()
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, (path, response.status_code)
+    return len(body), statistics.median(timings), body.count(marker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--comments', type=int, default=100, help='mean comments per post')
+    parser.add_argument('--limit', type=int, default=50, help='feed page size')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nerest-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('SLOW_QUERY_MS', '1000')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main as app_module
+
+    app = app_module.app
+    app_module.limiter.enabled = False
+    seed(app_module, users=50, posts=args.posts, comments=args.comments)
+    with app.app_context():
+        post_id = app_module.db.session.query(app_module.Post.id).order_by(app_module.Post.comment_count.desc()).limit(1).scalar()
+        comments = app_module.db.session.get(app_module.Post, post_id).comment_count
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench1', 'password': 'password'})
+    # Measure full renders, not fragment cache hits
+    app_module.fragment_cache.backend = app_module.LRUCache(1)
+
+    # The HTML thread cuts off deep and wide branches, so sizes are also compared per item
+    cases = [
+        (f"feed ({args.limit} posts)", f'/?limit={args.limit}', b"class='post-container'",
+         f'/api/v1/feed?limit={args.limit}', b'"title"', b'\xa5title'),
+        (f"thread ({comments} comments)", f'/post/{post_id}', b'id="comment-',
+         f'/api/v1/posts/{post_id}/comments?limit={app.config["API_COMMENT_MAX_PAGE_SIZE"]}', b'"parent_id"', b'\xa9parent_id'),
+    ]
+    formats = [('html', {}), ('json', {'Accept': 'application/json'})]
+    if app_module.msgpack is not None:
+        formats.append(('msgpack', {'Accept': 'application/msgpack'}))
+    print(f"serializer: {'orjson' if app_module.orjson else 'json'}, msgpack: {'yes' if app_module.msgpack else 'no'}")
+    for name, html_path, html_marker, api_path, json_marker, msgpack_marker in cases:
+        print(name)
+        for label, headers in formats:
+            path, marker = {'html': (html_path, html_marker), 'json': (api_path, json_marker),
+                            'msgpack': (api_path, msgpack_marker)}[label]
+            size, seconds, items = measure(client, path, headers, args.repeat, marker)
+            print(f"  {label:<8} {size / 1024:>9.1f} KiB  {seconds * 1000:>8.2f} ms  "
+                  f"{items:>5} items  {size / max(items, 1):>7.0f} B/item  {seconds * 1e6 / max(items, 1):>7.1f} us/item")
+
+
+if __name__ == '__main__':
+    main()
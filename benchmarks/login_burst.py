@@ -0,0 +1,98 @@
+"""Measure latency of / while a burst of logins hits the server.
+
+Runs the app on a local threaded WSGI server against a throwaway SQLite
+database and prints p50/p95/p99 of the feed during the burst, e.g.:
+
+    python benchmarks/login_burst.py --hash-workers 0   # hash on the request thread
+    python benchmarks/login_burst.py --hash-workers 4   # hash in a process pool
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nerest-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['PASSWORD_HASH_WORKERS'] = str(args.hash_workers)
+    os.environ['PASSWORD_HASH_MAX_PENDING'] = str(args.concurrency)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from werkzeug.serving import make_server
+    import main as app_module
+
+    app = app_module.app
+    app_module.limiter.enabled = False
+    with app.app_context():
+        app_module.db.create_all()
+        pwhash = app_module.generate_password_hash('password', app.config['PASSWORD_HASH_METHOD'])
+        app_module.db.session.add_all(
+            app_module.User(username=f'user{i}', password=pwhash) for i in range(args.users))
+        app_module.db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    def login(i):
+        data = urllib.parse.urlencode({'username': f'user{i % args.users}', 'password': 'password'}).encode()
+        try:
+            with urllib.request.urlopen(f'{base_url}/login', data=data) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    # A logged-in reader that keeps loading the feed during the burst
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+    opener.open(f'{base_url}/login', data=urllib.parse.urlencode({'username': 'user0', 'password': 'password'}).encode()).read()
+    feed_latencies = []
+    done = threading.Event()
+
+    def read_feed():
+        while not done.is_set():
+            start = time.perf_counter()
+            opener.open(f'{base_url}/').read()
+            feed_latencies.append(time.perf_counter() - start)
+
+    reader = threading.Thread(target=read_feed)
+    reader.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        statuses = list(pool.map(login, range(args.logins)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+    server.shutdown()
+    app_module.password_hasher.shutdown()
+
+    print(f"hash workers:      {args.hash_workers}")
+    print(f"logins:            {statuses.count(200)} ok, {statuses.count(503)} shed (503) in {elapsed:.2f}s")
+    print(f"feed requests:     {len(feed_latencies)}")
+    for pct in (50, 95, 99):
+        print(f"feed p{pct}:          {percentile(feed_latencies, pct) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
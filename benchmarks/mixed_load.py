@@ -0,0 +1,215 @@
+"""Drive the app through a realistic mix of feed reads, thread views, likes and comments.
+
+Seeds a throwaway SQLite database (or uses --database), runs logged-in clients
+for --duration seconds through the Flask test client or, with --server, a local
+threaded WSGI server, and reports throughput, latency percentiles per operation
+and SQL queries per request. Results can be saved and compared across commits:
+
+    python benchmarks/mixed_load.py --mix read-heavy --output before.json
+    python benchmarks/mixed_load.py --mix read-heavy --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from seed import seed
+
+MIXES = {
+    'read-heavy': {'feed': 60, 'thread': 30, 'like': 7, 'comment': 3},
+    'write-heavy': {'feed': 30, 'thread': 20, 'like': 30, 'comment': 20},
+    'feed-only': {'feed': 100},
+}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else (b'' if method == 'POST' else None)
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    print(f"\ncompared with {baseline.get('commit')} ({baseline['mix']}):")
+    rows = [('throughput', baseline['throughput'], results['throughput'])]
+    for op, stats in results['operations'].items():
+        if op in baseline['operations']:
+            for pct in ('p50', 'p95', 'p99'):
+                rows.append((f"{op} {pct} ms", baseline['operations'][op][pct], stats[pct]))
+    for name, before, after in rows:
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"  {name:<20} {before:>10.1f} -> {after:>10.1f}  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mix', choices=sorted(MIXES), default='read-heavy')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--server', action='store_true', help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--database', help='use an already seeded database URL instead of a fresh one')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='print the change against a previous JSON result')
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    else:
+        workdir = tempfile.mkdtemp(prefix='nerest-bench-')
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main as app_module
+
+    app = app_module.app
+    app_module.limiter.enabled = False
+    if not args.database:
+        counts = seed(app_module, users=max(args.users, args.concurrency), posts=args.posts, comments=args.comments,
+                      random_seed=args.seed)
+        print("seeded " + ", ".join(f"{count} {table}" for table, count in counts.items()))
+    with app.app_context():
+        post_ids = [post_id for post_id, in app_module.db.session.query(app_module.Post.id)
+                    .filter(app_module.Post.deleted_at.is_(None)).order_by(app_module.Post.id.desc())]
+        usernames = [name for name, in app_module.db.session.query(app_module.User.username)
+                     .filter(app_module.User.username.like('bench%')).limit(args.concurrency)]
+
+    server = None
+    if args.server:
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+    def make_client(username):
+        client = HTTPClient(base_url) if server else TestClient(app)
+        client.request('POST', '/login', {'username': username, 'password': 'password'})
+        return client
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        clients = list(pool.map(make_client, usernames))
+
+    mix = MIXES[args.mix]
+    operations, weights = list(mix), list(mix.values())
+    samples = {op: [] for op in operations}
+    errors = {op: 0 for op in operations}
+    metrics_before = app_module.request_metrics.snapshot()
+
+    def run(i):
+        rng = random.Random(args.seed + i)
+        client = clients[i]
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            op = rng.choices(operations, weights)[0]
+            # Skew towards newer posts, the way real traffic concentrates on the front page
+            post_id = post_ids[int(len(post_ids) * rng.random() ** 2)]
+            start = time.perf_counter()
+            if op == 'feed':
+                status = client.request('GET', rng.choice(['/', '/?sort=hot', '/?sort=top']))
+            elif op == 'thread':
+                status = client.request('GET', f'/post/{post_id}')
+            elif op == 'like':
+                status = client.request('POST', f'/like/{post_id}')
+            else:
+                status = client.request('POST', f'/post/{post_id}/comment', {'content': f'нагрузка {i} {rng.random()}'})
+            samples[op].append(time.perf_counter() - start)
+            if status >= 400:
+                errors[op] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        list(pool.map(run, range(len(clients))))
+    elapsed = time.perf_counter() - start
+    if server:
+        server.shutdown()
+    app_module.write_behind.close()
+
+    queries = {}
+    for endpoint, stats in app_module.request_metrics.snapshot().items():
+        before = metrics_before.get(endpoint, {'count': 0, 'sql_count': 0})
+        if stats['count'] > before['count'] and endpoint not in ('login', 'metrics'):
+            queries[endpoint] = round((stats['sql_count'] - before['sql_count']) / (stats['count'] - before['count']), 2)
+
+    total = sum(len(values) for values in samples.values())
+    results = {
+        'commit': git_commit(),
+        'mix': args.mix,
+        'mode': 'server' if server else 'test-client',
+        'concurrency': len(clients),
+        'duration': round(elapsed, 3),
+        'requests': total,
+        'throughput': round(total / elapsed, 1),
+        'operations': {op: {'count': len(values), 'errors': errors[op],
+                            **{f'p{pct}': round(percentile(values, pct) * 1000, 2) for pct in (50, 95, 99)}}
+                       for op, values in samples.items()},
+        'queries_per_request': queries,
+    }
+
+    print(f"mix {args.mix} ({results['mode']}, {len(clients)} clients): "
+          f"{total} requests in {elapsed:.2f}s ({results['throughput']}/s)")
+    for op, stats in results['operations'].items():
+        print(f"  {op:<8} n={stats['count']:<6} errors={stats['errors']:<4} "
+              f"p50={stats['p50']:.1f} ms  p95={stats['p95']:.1f} ms  p99={stats['p99']:.1f} ms")
+    print("queries per request: " + ", ".join(f"{endpoint}={count}" for endpoint, count in sorted(queries.items())))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
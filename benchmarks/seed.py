@@ -0,0 +1,98 @@
+"""Fill a database with synthetic users, posts, comment trees and likes.
+
+Rows are generated in memory and written with bulk INSERTs, so a few hundred
+thousand rows take seconds. Point DATABASE_URL at the database to fill, e.g.:
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/seed.py --users 1000 --posts 5000
+
+Seeded users are named bench<id> and share the password "password".
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+
+def insert_batches(db, model, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(db.insert(model), rows[start:start + batch_size])
+
+
+def seed(app_module, users=200, posts=1000, comments=20, depth=8, likes=30, days=30, batch_size=5000, random_seed=0):
+    """Generate and insert the data set; returns row counts per table.
+
+    Per post the number of comments and likes is drawn around the given means.
+    A reply continues the newest branch half of the time, so threads reach
+    `depth` levels while staying wide near the top.
+    """
+    rng = random.Random(random_seed)
+    db = app_module.db
+    app = app_module.app
+    now = datetime.utcnow()
+    with app.app_context():
+        db.create_all()
+        pwhash = app_module.generate_password_hash('password', app.config['PASSWORD_HASH_METHOD'])
+        first_user = (db.session.query(db.func.max(app_module.User.id)).scalar() or 0) + 1
+        first_post = (db.session.query(db.func.max(app_module.Post.id)).scalar() or 0) + 1
+        next_comment = (db.session.query(db.func.max(app_module.Comment.id)).scalar() or 0) + 1
+        user_ids = list(range(first_user, first_user + users))
+        user_rows = [{'id': i, 'username': f'bench{i}', 'password': pwhash} for i in user_ids]
+
+        post_rows, comment_rows, like_rows = [], [], []
+        for post_id in range(first_post, first_post + posts):
+            created_at = now - timedelta(seconds=rng.random() * days * 86400)
+            thread = []  # (comment id, depth, created_at, row)
+            for _ in range(int(rng.expovariate(1 / comments)) if comments else 0):
+                parent = None
+                if thread and rng.random() < 0.7:
+                    parent = thread[-1] if rng.random() < 0.5 else rng.choice(thread)
+                    if parent[1] + 1 >= depth:
+                        parent = None
+                comment_created = (parent[2] if parent else created_at) + timedelta(seconds=rng.randint(1, 3600))
+                row = {'id': next_comment, 'content': f'Комментарий {next_comment} ' + 'текст ' * rng.randint(3, 30),
+                       'author': f'bench{rng.choice(user_ids)}', 'post_id': post_id,
+                       'parent_id': parent[0] if parent else None, 'created_at': comment_created, 'reply_count': 0}
+                if parent:
+                    parent[3]['reply_count'] += 1
+                thread.append((next_comment, parent[1] + 1 if parent else 0, comment_created, row))
+                comment_rows.append(row)
+                next_comment += 1
+            likers = rng.sample(user_ids, min(users, int(rng.expovariate(1 / likes)) if likes else 0))
+            like_rows.extend({'user_id': user_id, 'post_id': post_id} for user_id in likers)
+            post_rows.append({'id': post_id, 'title': f'Пост {post_id}', 'content': 'Текст поста ' * rng.randint(5, 80),
+                              'author': f'bench{rng.choice(user_ids)}', 'created_at': created_at, 'likes': len(likers),
+                              'comment_count': len(thread), 'last_activity_at': max([created_at] + [c[2] for c in thread]),
+                              'hot_score': app_module.compute_hot_score(len(likers), len(thread), created_at)})
+
+        for model, rows in ((app_module.User, user_rows), (app_module.Post, post_rows),
+                            (app_module.Comment, comment_rows), (app_module.Like, like_rows)):
+            insert_batches(db, model, rows, batch_size)
+        db.session.commit()
+        if app_module.search_available():
+            app_module.rebuild_search_index()
+    return {'users': len(user_rows), 'posts': len(post_rows), 'comments': len(comment_rows), 'likes': len(like_rows)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=20, help='mean comments per post')
+    parser.add_argument('--depth', type=int, default=8, help='maximum reply depth')
+    parser.add_argument('--likes', type=int, default=30, help='mean likes per post')
+    parser.add_argument('--days', type=int, default=30, help='spread post creation over this many days')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main as app_module
+
+    start = time.perf_counter()
+    counts = seed(app_module, args.users, args.posts, args.comments, args.depth, args.likes, args.days, random_seed=args.seed)
+    print(", ".join(f"{count} {table}" for table, count in counts.items()) + f" in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Measure sustained comment/like throughput with and without the write-behind queue.
+
+Runs the app on a local threaded WSGI server against a throwaway SQLite
+database, lets logged-in clients post comments and toggle likes as fast as
+they can, then prints writes/sec, request latency and the time the queue
+needed to drain, e.g.:
+
+    python benchmarks/write_behind.py                 # commit per request
+    python benchmarks/write_behind.py --write-behind  # batched group commits
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Time the write itself, not the page the comment form redirects to
+    def redirect_request(self, *args):
+        return None
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--write-behind', action='store_true')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--posts', type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nerest-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['WRITE_BEHIND'] = '1' if args.write_behind else '0'
+    os.environ['PASSWORD_HASH_WORKERS'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from werkzeug.serving import make_server
+    import main as app_module
+
+    app = app_module.app
+    app_module.limiter.enabled = False
+    with app.app_context():
+        app_module.db.create_all()
+        pwhash = app_module.generate_password_hash('password', app.config['PASSWORD_HASH_METHOD'])
+        app_module.db.session.add_all(
+            app_module.User(username=f'user{i}', password=pwhash) for i in range(args.concurrency))
+        app_module.db.session.add_all(
+            app_module.Post(title=f'post {i}', content='benchmark', author='user0') for i in range(args.posts))
+        app_module.db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    def login(i):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), NoRedirect())
+        data = urllib.parse.urlencode({'username': f'user{i}', 'password': 'password'}).encode()
+        try:
+            opener.open(f'{base_url}/login', data=data).read()
+        except urllib.error.HTTPError:
+            pass
+        return opener
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        openers = list(pool.map(login, range(args.concurrency)))
+
+    deadline = time.perf_counter() + args.duration
+    latencies = []
+
+    def client(i):
+        opener = openers[i]
+        n = 0
+        while time.perf_counter() < deadline:
+            post_id = (i + n) % args.posts + 1
+            start = time.perf_counter()
+            if n % 2:
+                opener.open(f'{base_url}/like/{post_id}', data=b'').read()
+            else:
+                data = urllib.parse.urlencode({'content': f'comment {i}-{n}'}).encode()
+                try:
+                    opener.open(f'{base_url}/post/{post_id}/comment', data=data).read()
+                except urllib.error.HTTPError as e:
+                    if e.code != 302:
+                        raise
+            latencies.append(time.perf_counter() - start)
+            n += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(client, range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    drain_start = time.perf_counter()
+    app_module.write_behind.close()
+    drain = time.perf_counter() - drain_start
+    server.shutdown()
+
+    with app.app_context():
+        comments = app_module.Comment.query.count()
+        likes = app_module.Like.query.count()
+        counted = app_module.db.session.query(app_module.db.func.sum(app_module.Post.likes)).scalar() or 0
+
+    print(f"write-behind:      {'on' if args.write_behind else 'off'}")
+    print(f"writes:            {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s)")
+    for pct in (50, 95, 99):
+        print(f"write p{pct}:         {percentile(latencies, pct) * 1000:.1f} ms")
+    print(f"drain:             {drain * 1000:.1f} ms")
+    print(f"stored:            {comments} comments, {likes} likes (post counters: {counted})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py
+
+The app is imported and the schema created or migrated once in the master (preload_app);
+workers are forked from it and each runs main.init_worker(). On SIGTERM a
+worker fails /readyz for DRAIN_SECONDS, ends its live update streams, then
+stops accepting connections and finishes the requests it has.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'main:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# Behind a load balancer export TRUSTED_PROXIES (its number of hops, usually 1) so the rate
+# limiter and /metrics see client addresses instead of the balancer's
+preload_app = True
+
+# Threads let one worker wait on I/O and hold open SSE streams. WEB_THREADS is
+# exported before the app is imported, which caps live update streams at half
+# the threads, so page views never queue behind them
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.setdefault('WEB_THREADS', '32'))
+
+timeout = 30
+keepalive = 5
+graceful_timeout = int(os.environ.get('DRAIN_SECONDS', 5)) + 30
+
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    import main
+    main.init_worker()
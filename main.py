@@ -1,346 +1,1248 @@
-from flask import Flask, request, redirect, url_for, session, render_template_string, flash, jsonify, send_from_directory
+from flask import Flask, request, redirect, url_for, session, render_template, flash, jsonify, g, abort, Response, stream_with_context
+from flask import before_render_template, has_app_context, has_request_context, make_response, template_rendered
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from datetime import datetime
+from limits.storage import Storage, SlidingWindowCounterSupport
+from limits.storage.base import TimestampedSlidingWindow
+import click
+import gzip
+import hashlib
+import hmac
+import ipaddress
+import mimetypes
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta
+import atexit
+import json
+import math
 import os
-
-app = Flask(__name__)
+import queue
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import brotli
+except ImportError:  # optional: without it assets are precompressed with gzip only
+    brotli = None
+try:
+    import fcntl
+except ImportError:  # optional: without it (Windows) every process runs the periodic jobs
+    fcntl = None
+try:
+    import msgpack
+except ImportError:  # optional: without it the API only answers in JSON
+    msgpack = None
+try:
+    import orjson
+except ImportError:  # optional: the API falls back to the standard json module
+    orjson = None
+
+app = Flask(__name__, static_folder=None)
 app.secret_key = 'super_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///nerestreddit.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///nerestreddit.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Instrumentation: per-request wall, SQL and template time go to Server-Timing and /metrics;
+# statements slower than SLOW_QUERY_MS are logged with their SQL
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 100))
+# /metrics and /cache/stats need "Authorization: Bearer <METRICS_TOKEN>" when it is set, and
+# otherwise only answer loopback addresses
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Number of reverse proxies / load balancers in front of the app whose X-Forwarded-For and
+# X-Forwarded-Proto are trusted. The client address they report is what the rate limiter
+# keys on and what /metrics checks, so leave it 0 unless every request passes through them
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+# Fingerprinted static assets never change under the same URL, so caches may keep them for a year
+app.config['ASSET_MAX_AGE'] = int(os.environ.get('ASSET_MAX_AGE', 31536000))
+# Engine profile: 'sqlite' (library defaults), 'sqlite-wal' (tuned single host) or 'postgres' (multi-node, set DATABASE_URL)
+app.config['DB_PROFILE'] = os.environ.get('DB_PROFILE', 'sqlite-wal')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'foreign_keys': 'ON',
+}
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 20))
+app.config['FEED_MAX_PAGE_SIZE'] = 100
+app.config['COMMENT_MAX_DEPTH'] = int(os.environ.get('COMMENT_MAX_DEPTH', 8))
+app.config['COMMENT_MAX_CHILDREN'] = int(os.environ.get('COMMENT_MAX_CHILDREN', 50))
+app.config['TEMPLATE_BYTECODE_CACHE_DIR'] = os.environ.get('TEMPLATE_BYTECODE_CACHE_DIR')
+# Stream the feed and post pages to the client while rows are still being read
+app.config['STREAMING_RENDER'] = os.environ.get('STREAMING_RENDER', '0') == '1'
+app.config['STREAM_BUFFER_SIZE'] = int(os.environ.get('STREAM_BUFFER_SIZE', 16))
+app.config['STREAM_CHUNK_ROWS'] = int(os.environ.get('STREAM_CHUNK_ROWS', 100))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+# Any object with get(key) / set(key, value), e.g. a cachelib cache; defaults to an in-process LRU
+app.config['FRAGMENT_CACHE_BACKEND'] = None
+# Seconds between background rebuilds of Post.likes from the Like table; 0 disables
+app.config['LIKE_RECONCILE_INTERVAL'] = int(os.environ.get('LIKE_RECONCILE_INTERVAL', 300))
+# Soft-delete posts and purge their rows in the background instead of inside the request
+app.config['POST_SOFT_DELETE'] = os.environ.get('POST_SOFT_DELETE', '0') == '1'
+app.config['POST_PURGE_INTERVAL'] = int(os.environ.get('POST_PURGE_INTERVAL', 60))
+app.config['POST_PURGE_BATCH_SIZE'] = int(os.environ.get('POST_PURGE_BATCH_SIZE', 1000))
+# Password hashing runs in a process pool; 0 workers hashes on the request thread
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+app.config['PASSWORD_HASH_TIMEOUT'] = int(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+# Changing the method or its cost rehashes each password on its owner's next login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# Hot ranking: seconds of age that cost one order of magnitude of likes, and the
+# window of recent posts whose scores the periodic refresh job recomputes
+app.config['HOT_SCORE_GRAVITY'] = int(os.environ.get('HOT_SCORE_GRAVITY', 45000))
+app.config['HOT_REFRESH_INTERVAL'] = int(os.environ.get('HOT_REFRESH_INTERVAL', 600))
+app.config['HOT_REFRESH_WINDOW_DAYS'] = int(os.environ.get('HOT_REFRESH_WINDOW_DAYS', 7))
+# Write-behind: comments and likes are validated in the request and committed by a
+# background thread in group transactions every WRITE_BEHIND_INTERVAL_MS or WRITE_BEHIND_BATCH items
+app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND', '0') == '1'
+app.config['WRITE_BEHIND_INTERVAL_MS'] = int(os.environ.get('WRITE_BEHIND_INTERVAL_MS', 50))
+app.config['WRITE_BEHIND_BATCH'] = int(os.environ.get('WRITE_BEHIND_BATCH', 500))
+app.config['WRITE_BEHIND_MAX_PENDING'] = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000))
+# Live updates: post pages subscribe over server-sent events; one poller per process reads the
+# subscribed posts every UPDATES_TICK_MS and sends the same coalesced event to every viewer
+app.config['UPDATES_TICK_MS'] = int(os.environ.get('UPDATES_TICK_MS', 1000))
+app.config['UPDATES_KEEPALIVE'] = int(os.environ.get('UPDATES_KEEPALIVE', 15))
+# Each open stream holds a server thread. Under a thread-pool server (WEB_THREADS, set by
+# gunicorn.conf.py) streams may take at most half the threads so page views always get the rest
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 0))
+app.config['UPDATES_MAX_SUBSCRIBERS'] = int(os.environ.get('UPDATES_MAX_SUBSCRIBERS', 1000))
+if app.config['WEB_THREADS']:
+    app.config['UPDATES_MAX_SUBSCRIBERS'] = min(app.config['UPDATES_MAX_SUBSCRIBERS'], app.config['WEB_THREADS'] // 2)
+app.config['SEARCH_PAGE_SIZE'] = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+# Comments per page of /api/v1/posts/<id>/comments
+app.config['API_COMMENT_PAGE_SIZE'] = int(os.environ.get('API_COMMENT_PAGE_SIZE', 500))
+app.config['API_COMMENT_MAX_PAGE_SIZE'] = int(os.environ.get('API_COMMENT_MAX_PAGE_SIZE', 2000))
+# Seconds a session's cached user id is trusted before it is checked against the User table again
+app.config['IDENTITY_RECHECK_INTERVAL'] = int(os.environ.get('IDENTITY_RECHECK_INTERVAL', 60))
+# `flask archive-threads` moves idle threads into this SQLite file; their pages are then
+# read from it through a read-only connection
+app.config['ARCHIVE_PATH'] = os.environ.get('ARCHIVE_PATH', os.path.join(app.instance_path, 'archive.db'))
+# Rows per chunk file written by `flask export-data`, and per executemany batch when copying rows
+app.config['EXPORT_CHUNK_ROWS'] = int(os.environ.get('EXPORT_CHUNK_ROWS', 100000))
+app.config['TRANSFER_BATCH_SIZE'] = int(os.environ.get('TRANSFER_BATCH_SIZE', 5000))
+# Seconds a worker keeps serving after SIGTERM while /readyz already fails, so the
+# load balancer stops routing to it before it stops accepting connections
+app.config['DRAIN_SECONDS'] = int(os.environ.get('DRAIN_SECONDS', 5))
+
+DB_PROFILES = {
+    'sqlite': {},
+    'sqlite-wal': {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        # sqlite3 keeps this many prepared statements per connection
+        'connect_args': {'cached_statements': 512},
+        'query_cache_size': 1200,
+    },
+    'postgres': {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'query_cache_size': 1200,
+    },
+}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = DB_PROFILES[app.config['DB_PROFILE']]
+
+# Read routing: GET requests read through their own engine, a replica (READ_REPLICA_URL) or, by
+# default with SQLite in WAL mode, a read-only connection pool on the same file; writes and
+# everything outside GET requests use the primary. After a write the user reads from the
+# primary for READ_YOUR_WRITES_SECONDS, long enough for a replica to catch up.
+app.config['READ_REPLICA_URL'] = os.environ.get(
+    'READ_REPLICA_URL', app.config['SQLALCHEMY_DATABASE_URI'] if app.config['DB_PROFILE'] == 'sqlite-wal' else '')
+app.config['READ_YOUR_WRITES_SECONDS'] = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+if app.config['READ_REPLICA_URL']:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['READ_REPLICA_URL']}
+
+# Rate limits are sliding-window counters kept in storage shared by every worker. The default
+# SQLite file covers a single host; point RATELIMIT_STORAGE_URI at redis://host:6379 for several nodes
+app.config['RATELIMIT_STORAGE_URI'] = os.environ.get(
+    'RATELIMIT_STORAGE_URI', 'sqlite:///' + os.path.join(app.instance_path, 'ratelimit.db'))
+app.config['RATELIMIT_STRATEGY'] = os.environ.get('RATELIMIT_STRATEGY', 'sliding-window-counter')
+
+class SQLiteLimiterStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """Rate limit counters in a SQLite file, registered with `limits` for sqlite:/// URIs.
+
+    Each limited key holds at most two rows (the current and previous window of the
+    sliding-window counter); expired rows are swept every SWEEP_INTERVAL seconds.
+    """
+    STORAGE_SCHEME = ['sqlite']
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri[len('sqlite:///'):]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        self._next_sweep = 0
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # One autocommit connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_limit "
+                         "(key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL NOT NULL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _sweep(self, conn, now):
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.SWEEP_INTERVAL
+            conn.execute("DELETE FROM rate_limit WHERE expires_at <= ?", (now,))
+
+    def _incr(self, conn, key, expiry, amount, now):
+        return conn.execute(
+            "INSERT INTO rate_limit (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END, "
+            "expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END "
+            "RETURNING value", (key, amount, now + expiry, now, now)).fetchone()[0]
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        conn = self._connection()
+        self._sweep(conn, now)
+        return self._incr(conn, key, expiry, amount, now)
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM rate_limit WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT expires_at FROM rate_limit WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        return row[0] if row else now
+
+    def check(self):
+        try:
+            self._connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._connection().execute("DELETE FROM rate_limit").rowcount
+
+    def clear(self, key):
+        self._connection().execute("DELETE FROM rate_limit WHERE key = ?", (key,))
+
+    def _sliding_window(self, conn, key, expiry, now):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        counts = dict(conn.execute("SELECT key, value FROM rate_limit WHERE key IN (?, ?) AND expires_at > ?",
+                                   (previous_key, current_key, now)))
+        previous_count = counts.get(previous_key, 0)
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry if previous_count else 0.0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, counts.get(current_key, 0), current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        conn = self._connection()
+        self._sweep(conn, now)
+        # Take the write lock up front so check-and-increment is atomic across worker processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous_count, previous_ttl, current_count, _ = self._sliding_window(conn, key, expiry, now)
+            allowed = math.floor(previous_count * previous_ttl / expiry + current_count) + amount <= limit
+            if allowed:
+                # The current window is read as the previous one for another full window
+                self._incr(conn, self.sliding_window_keys(key, expiry, now)[1], 2 * expiry, amount, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed
+
+    def get_sliding_window(self, key, expiry):
+        return self._sliding_window(self._connection(), key, expiry, time.time())
+
+    def clear_sliding_window(self, key, expiry):
+        self._connection().execute("DELETE FROM rate_limit WHERE key IN (?, ?)",
+                                   self.sliding_window_keys(key, expiry, time.time()))
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 # Initialize Limiter
 limiter = Limiter(
     get_remote_address,
     app=app,
-    default_limits=["200 per day", "50 per hour"],
-    default_limits_exceeded_message="Похоже На Спам! Лимит-1 публикация раз в 10 секунд!"
+    default_limits=["200 per day", "50 per hour"]
 )
 
-db = SQLAlchemy(app)
+def reads_from_replica():
+    """True for GET and HEAD requests, unless this user wrote within READ_YOUR_WRITES_SECONDS."""
+    return (has_request_context() and request.method in ('GET', 'HEAD')
+            and session.get('primary_until', 0) <= time.time())
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """Sends reads made while serving GET requests to the replica engine, everything else to the primary.
+
+    The first flush or write statement moves the session to the primary for
+    the rest of its life, so a request always reads back what it wrote.
+    """
+    _on_primary = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = self._db.engines.get('replica')
+        if bind is None and replica is not None and not self._on_primary:
+            if not self._flushing and not isinstance(clause, (db.Insert, db.Update, db.Delete)) and reads_from_replica():
+                return replica
+            self._on_primary = True
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def apply_replica_pragmas(dbapi_connection, connection_record):
+    apply_sqlite_pragmas(dbapi_connection, connection_record)
+    # The replica pool shares the primary's file: make a stray write fail instead of taking the write lock
+    dbapi_connection.execute("PRAGMA query_only=ON")
+
+if app.config['DB_PROFILE'] == 'sqlite-wal':
+    with app.app_context():
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+        if 'replica' in db.engines and db.engines['replica'].dialect.name == 'sqlite':
+            event.listen(db.engines['replica'], 'connect', apply_replica_pragmas)
+
+@app.after_request
+def stick_to_primary(response):
+    if app.config['READ_REPLICA_URL'] and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        session['primary_until'] = time.time() + app.config['READ_YOUR_WRITES_SECONDS']
+    return response
+
+class RequestMetrics:
+    """Per-endpoint latency histograms and SQL/template totals in Prometheus text format."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def observe(self, endpoint, perf, duration):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'buckets': [0] * len(self.BUCKETS), 'count': 0, 'sum': 0.0,
+                    'sql_count': 0, 'sql_time': 0.0, 'render_time': 0.0}
+            for i, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    stats['buckets'][i] += 1
+            stats['count'] += 1
+            stats['sum'] += duration
+            stats['sql_count'] += perf['sql_count']
+            stats['sql_time'] += perf['sql_time']
+            stats['render_time'] += perf['render_time']
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in self._endpoints.items()}
+
+    def render(self):
+        endpoints = sorted(self.snapshot().items())
+        lines = ["# HELP nerest_request_duration_seconds Request wall time, including streamed bodies.",
+                 "# TYPE nerest_request_duration_seconds histogram"]
+        for name, stats in endpoints:
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                lines.append(f'nerest_request_duration_seconds_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+            lines.append(f'nerest_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'nerest_request_duration_seconds_sum{{endpoint="{name}"}} {stats["sum"]:.6f}')
+            lines.append(f'nerest_request_duration_seconds_count{{endpoint="{name}"}} {stats["count"]}')
+        for metric, key, help_text in (
+                ('nerest_sql_queries_total', 'sql_count', 'SQL statements executed by requests.'),
+                ('nerest_sql_duration_seconds_total', 'sql_time', 'Time requests spent in SQL statements.'),
+                ('nerest_template_render_seconds_total', 'render_time', 'Time requests spent rendering templates and fragments, excluding SQL.')):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stats in endpoints:
+                value = stats[key] if key == 'sql_count' else f"{stats[key]:.6f}"
+                lines.append(f'{metric}{{endpoint="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+def current_perf():
+    return g.get('perf') if has_app_context() else None
+
+# Listen on the Engine class so every engine the app creates is measured
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    perf = current_perf()
+    if perf is not None:
+        perf['sql_count'] += 1
+        perf['sql_time'] += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        app.logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+def start_render_timer():
+    # Nested renders (fragments inside a template) count once, and SQL run while rendering stays in db
+    perf = current_perf()
+    if perf is not None:
+        if not perf['render_depth']:
+            perf['render_started'] = (time.perf_counter(), perf['sql_time'])
+        perf['render_depth'] += 1
+
+def stop_render_timer():
+    perf = current_perf()
+    if perf is not None and perf['render_depth']:
+        perf['render_depth'] -= 1
+        if not perf['render_depth']:
+            started, sql_time = perf.pop('render_started')
+            perf['render_time'] += time.perf_counter() - started - (perf['sql_time'] - sql_time)
+
+@contextmanager
+def render_timer():
+    start_render_timer()
+    try:
+        yield
+    finally:
+        stop_render_timer()
+
+def timed_pieces(pieces):
+    """Count the time spent producing each piece of a lazily rendered page or fragment as render time."""
+    pieces = iter(pieces)
+    while True:
+        with render_timer():
+            piece = next(pieces, None)
+        if piece is None:
+            return
+        yield piece
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    start_render_timer()
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    stop_render_timer()
+
+@app.before_request
+def start_request_timer():
+    if app.config['METRICS_ENABLED']:
+        g.perf = {'started': time.perf_counter(), 'sql_count': 0, 'sql_time': 0.0, 'render_time': 0.0, 'render_depth': 0}
+
+@app.after_request
+def add_server_timing(response):
+    perf = g.get('perf')
+    if perf is None:
+        return response
+    elapsed = time.perf_counter() - perf['started']
+    # Streamed pages report time to first byte here; /metrics gets the full duration on close
+    response.headers['Server-Timing'] = (
+        f'app;dur={elapsed * 1000:.1f}, db;dur={perf["sql_time"] * 1000:.1f};desc="{perf["sql_count"]} queries", '
+        f'tpl;dur={perf["render_time"] * 1000:.1f}')
+    endpoint = request.endpoint or 'unmatched'
+    response.call_on_close(lambda: request_metrics.observe(endpoint, perf, time.perf_counter() - perf['started']))
+    return response
+
+class LRUCache:
+    """Thread-safe in-process LRU used as the default fragment cache backend."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+class FragmentCache:
+    """Cache of user-independent HTML fragments keyed by (namespace, id, version).
+
+    The version is the Post.changed_at of the data shown, which every write
+    bumps in the same transaction. A write in any worker, CLI command or job
+    therefore makes the old entries unreachable without invalidating anything,
+    and stale entries simply age out of the backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, namespace, key_id, version, variant):
+        return ":".join(str(part) for part in (namespace, key_id, version) + variant)
+
+    def get(self, namespace, key_id, version, *variant):
+        html = self.backend.get(self._key(namespace, key_id, version, variant))
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return html
+
+    def get_or_render(self, namespace, key_id, version, render, *variant):
+        html = self.get(namespace, key_id, version, *variant)
+        if html is None:
+            with render_timer():
+                html = str(render())
+            self.backend.set(self._key(namespace, key_id, version, variant), html)
+        return html
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+        if hasattr(self.backend, '__len__'):
+            stats["size"] = len(self.backend)
+        return stats
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_BACKEND'] or LRUCache(app.config['FRAGMENT_CACHE_SIZE']))
 
 # Models
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
+    # Bumped on rename/delete so sessions holding an older stamp are rejected
+    session_version = db.Column(db.Integer, nullable=False, default=1)
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    author = db.Column(db.String(80), nullable=False)
+    author = db.Column(db.String(80), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     likes = db.Column(db.Integer, default=0)
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    # Materialized "hot" rank, see compute_hot_score()
+    hot_score = db.Column(db.Float, nullable=True)
+    # Denormalized thread metadata, maintained by record_comment() and
+    # repaired by reconcile_thread_counts()
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    # Bumped whenever anything shown for the post changes; drives the HTTP validators
+    changed_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, index=True)
+
+    # Composite indexes for keyset pagination of the feeds: (created_at, id) for
+    # "new" (it also serves any lookup or ordering on created_at alone), and
+    # (hot_score, id) / (likes, id) / (last_activity_at, id) for the ranked feeds
+    __table_args__ = (
+        db.Index('ix_post_created_at_id', 'created_at', 'id'),
+        db.Index('ix_post_hot_score_id', 'hot_score', 'id'),
+        db.Index('ix_post_likes_id', 'likes', 'id'),
+        db.Index('ix_post_last_activity_id', 'last_activity_at', 'id'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     author = db.Column(db.String(80), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
+    # No ON DELETE CASCADE here: SQLite would recurse once per thread level and
+    # fail past 1000; threads are always deleted as a whole by post_id instead
     parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Number of direct replies, maintained by record_comment()
+    reply_count = db.Column(db.Integer, nullable=False, default=0)
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
 
+    # (post_id, id) serves the flat, id-ordered comment pages of the API
+    __table_args__ = (
+        db.Index('ix_comment_post_parent_created', 'post_id', 'parent_id', 'created_at'),
+        db.Index('ix_comment_post_id', 'post_id', 'id'),
+    )
+
+class PostTombstone(db.Model):
+    # One row per hard-deleted post, so feed validators notice posts that disappeared
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Like(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False)
 
     # Unique constraint to ensure a user can like a post only once
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id'),)
+    __table_args__ = (db.UniqueConstraint('user_id', 'post_id'), db.Index('ix_like_post_id', 'post_id'))
+
+# Full-text index over post titles/contents and comments (SQLite FTS5). Posts
+# are stored under rowid -post.id and comments under rowid comment.id, so rows
+# can be removed by rowid without scanning the index.
+event.listen(db.metadata, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5("
+    "title, content, post_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')"
+).execute_if(dialect='sqlite'))
+event.listen(db.metadata, 'before_drop', DDL("DROP TABLE IF EXISTS post_search").execute_if(dialect='sqlite'))
+
+class ServiceBusy(Exception):
+    pass
+
+class PasswordHasherBusy(ServiceBusy):
+    pass
+
+class WriteQueueFull(ServiceBusy):
+    pass
+
+class PasswordHasher:
+    """Runs werkzeug's KDF in a bounded process pool so logins can't starve other routes.
+
+    At most workers + max_pending hashes are in flight; past that callers get
+    PasswordHasherBusy right away instead of queueing behind the storm.
+    """
+
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+        try:
+            with self._lock:
+                # Created lazily so pre-fork servers don't share one pool across workers. The
+                # children must not be forked from this process: its other threads may hold
+                # locks (logging, sqlite, connection pools) that would stay held in the copy
+                if self._executor is None:
+                    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(start_method))
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash finishes or is cancelled, not until the caller gives up,
+        # so hashes abandoned on timeout still count against the limit
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Drop it from the queue if no worker has picked it up yet
+            future.cancel()
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_MAX_PENDING'], app.config['PASSWORD_HASH_TIMEOUT'])
+
+@lru_cache()
+def hash_method_prefix(method):
+    # werkzeug fills in default parameters, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def password_needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != hash_method_prefix(app.config['PASSWORD_HASH_METHOD'])
 
 def is_logged_in():
-    return 'username' in session
+    return get_user_id() is not None
 
-def get_user_id():
-    if is_logged_in():
+def login_session(user):
+    session['username'] = user.username
+    session['user_id'] = user.id
+    session['user_version'] = user.session_version
+    session['identity_checked_at'] = time.time()
+
+def logout_session():
+    for key in ('username', 'user_id', 'user_version', 'identity_checked_at'):
+        session.pop(key, None)
+
+def invalidate_user_sessions(user):
+    """Call after renaming or before deleting a user to log out all their sessions."""
+    user.session_version += 1
+
+def resolve_session_user():
+    user_id = session.get('user_id')
+    checked_at = session.get('identity_checked_at', 0)
+    if user_id and time.time() - checked_at < app.config['IDENTITY_RECHECK_INTERVAL']:
+        return user_id
+
+    # Stale stamp, or a session from before ids were stored: verify once
+    if user_id:
+        user = db.session.get(User, user_id)
+        valid = user is not None and user.session_version == session.get('user_version')
+    else:
         user = User.query.filter_by(username=session['username']).first()
-        if user:
-            return user.id
-    return None
+        valid = user is not None
+    if not valid or user.username != session['username']:
+        logout_session()
+        return None
+    login_session(user)
+    return user.id
 
-def user_liked_post(post_id):
+def get_user_id():
+    # Resolve the current user once per request; usually costs no queries
+    if 'user_id' not in g:
+        g.user_id = resolve_session_user() if 'username' in session else None
+    return g.user_id
+
+def get_liked_post_ids(post_ids):
+    """Return the subset of post_ids liked by the current user in a single query."""
     user_id = get_user_id()
-    if user_id:
-        like = Like.query.filter_by(user_id=user_id, post_id=post_id).first()
-        return like is not None
-    return False
-
-# Base template with dark blue theme
-base_html = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <title>{{ title }}</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
-    <script>
-        function showNotification(message, type) {
-            const notification = document.createElement('div');
-            notification.className = `fixed top-4 right-4 p-4 rounded-md shadow-md ${type === 'success' ? 'bg-blue-500' : 'bg-red-500'} text-white`;
-            notification.textContent = message;
-            document.body.appendChild(notification);
-
-            setTimeout(() => {
-                notification.style.opacity = '0';
-                notification.style.transition = 'opacity 0.5s';
-                setTimeout(() => {
-                    document.body.removeChild(notification);
-                }, 500);
-            }, 3000);
-        }
-
-        {% if notification %}
-            document.addEventListener('DOMContentLoaded', function() {
-                showNotification("{{ notification.message }}", "{{ notification.type }}");
-            });
-        {% endif %}
-
-        async function likePost(postId) {
-            try {
-                const response = await fetch(`/like/${postId}`, {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-Requested-With': 'XMLHttpRequest'
-                    }
-                });
-                const data = await response.json();
-                if (data.success) {
-                    const likeCount = document.getElementById(`like-count-${postId}`);
-                    likeCount.textContent = data.likes;
-
-                    const likeBtn = document.getElementById(`like-btn-${postId}`);
-                    if (data.liked) {
-                        likeBtn.innerHTML = '<i class="fas fa-heart text-blue-500"></i>';
-                    } else {
-                        likeBtn.innerHTML = '<i class="far fa-heart"></i>';
-                    }
-                } else if (data.error === "Необходимо войти") {
-                    window.location.href = "/login";
-                }
-            } catch (error) {
-                console.error('Error liking post:', error);
-            }
-        }
-
-        async function deletePost(postId) {
-            if (confirm('Вы уверены, что хотите удалить этот пост?')) {
-                try {
-                    const response = await fetch(`/delete/${postId}`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'X-Requested-With': 'XMLHttpRequest'
-                        }
-                    });
-                    const data = await response.json();
-                    if (data.success) {
-                        showNotification(data.message, 'success');
-                        setTimeout(() => {
-                            window.location.href = data.redirect;
-                        }, 1000);
-                    } else {
-                        showNotification(data.message, 'error');
-                    }
-                } catch (error) {
-                    console.error('Error deleting post:', error);
-                }
-            }
-        }
-
-        async function registerUser(event) {
-            event.preventDefault();
-            const form = event.target;
-            const formData = new FormData(form);
-            const response = await fetch(form.action, {
-                method: 'POST',
-                body: formData
-            });
-            const data = await response.json();
-            if (data.success) {
-                showNotification(data.message, 'success');
-                setTimeout(() => {
-                    window.location.href = data.redirect;
-                }, 1000);
-            } else {
-                showNotification(data.message, 'error');
-            }
-        }
-
-        async function loginUser(event) {
-            event.preventDefault();
-            const form = event.target;
-            const formData = new FormData(form);
-            const response = await fetch(form.action, {
-                method: 'POST',
-                body: formData
-            });
-            const data = await response.json();
-            if (data.success) {
-                showNotification(data.message, 'success');
-                setTimeout(() => {
-                    window.location.href = data.redirect;
-                }, 1000);
-            } else {
-                showNotification(data.message, 'error');
-            }
-        }
-
-        async function createPost(event) {
-            event.preventDefault();
-            const form = event.target;
-            const formData = new FormData(form);
-            const response = await fetch(form.action, {
-                method: 'POST',
-                body: formData
-            });
-            const data = await response.json();
-            if (data.success) {
-                showNotification(data.message, 'success');
-                setTimeout(() => {
-                    window.location.href = data.redirect;
-                }, 1000);
-            } else {
-                showNotification(data.message, 'error');
-            }
-        }
-
-        function toggleReplyForm(commentId) {
-            const replyForm = document.getElementById(`reply-form-${commentId}`);
-            replyForm.classList.toggle('hidden');
-        }
-    </script>
-    <style>
-        body {
-            background-color: #0f172a; /* dark blue */
-            color: #e2e8f0;
-        }
-        .bg-white, .bg-gray-900 {
-            background-color: #1e3a8a; /* darker blue */
-        }
-        .text-gray-900 {
-            color: #e2e8f0;
-        }
-        .text-gray-500 {
-            color: #94a3b8;
-        }
-        .text-gray-600 {
-            color: #cbd5e1;
-        }
-        .border-gray-200 {
-            border-color: #334155;
-        }
-        input, textarea, button {
-            background-color: #1e3a8a;
-            color: #e2e8f0;
-            border-color: #334155;
-        }
-        input::placeholder, textarea::placeholder {
-            color: #94a3b8;
-        }
-        a {
-            color: #3b82f6;
-        }
-        .nav-link {
-            text-decoration: none !important;
-        }
-        .nav-link:hover {
-            color: #60a5fa;
-            text-decoration: none !important;
-        }
-        .post-container {
-            background-color: #1e3a8a;
-            border: 1px solid #334155;
-            border-radius: 8px;
-            padding: 16px;
-            margin-bottom: 16px;
-        }
-        .post-title {
-            color: #60a5fa;
-        }
-        .post-content {
-            color: #e2e8f0;
-        }
-        .comment-container {
-            background-color: #1e40af;
-            border: 1px solid #2563eb;
-            border-radius: 8px;
-            padding: 16px;
-            margin-top: 8px;
-        }
-        .comment-content {
-            color: #e2e8f0;
-        }
-        /* Глобальные переопределения для всех белых элементов */
-        .bg-white, .bg-gray-100, .bg-gray-50 {
-            background-color: #1e3a8a !important;
-        }
-        .shadow-md, .shadow-lg, .shadow-xl {
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.3);
-        }
-    </style>
-</head>
-<body class="bg-blue-950 text-blue-100">
-    <div class="max-w-3xl mx-auto py-8 px-4">
-        <div class="mb-6 flex justify-between items-center">
-            <div class="flex items-center">
-                <img src="{{ url_for('serve_image', filename='nerest.png') }}" alt="NerestReddit Logo" class="h-10 mr-2">
-                <h1 class="text-3xl font-bold text-red-500"><a href='{{ url_for('index') }}' class="nav-link">NerestReddit</a></h1>
-            </div>
-            <div class="space-x-4">
-                {% if session.get('username') %}
-                    <span class="text-blue-300">Привет, {{ session['username'] }}!</span>
-                    <a href="{{ url_for('create_post') }}" class="text-blue-500 nav-link">Создать пост</a>
-                    <a href="{{ url_for('logout') }}" class="text-blue-500 nav-link">Выйти</a>
-                {% else %}
-                    <a href="{{ url_for('login') }}" class="text-blue-500 nav-link">Войти</a>
-                    <a href="{{ url_for('register') }}" class="text-blue-500 nav-link">Регистрация</a>
-                {% endif %}
-            </div>
-        </div>
-        {{ content | safe }}
-    </div>
-</body>
-</html>
-"""
+    post_ids = list(post_ids)
+    if not user_id or not post_ids:
+        return set()
+    rows = db.session.query(Like.post_id).filter(Like.user_id == user_id, Like.post_id.in_(post_ids)).all()
+    return {row.post_id for row in rows}
+
+def user_liked_post(post_id):
+    return post_id in get_liked_post_ids([post_id])
+
+def get_post_or_404(post_id):
+    return Post.query.filter_by(id=post_id, deleted_at=None).first_or_404()
+
+def search_available():
+    return db.engine.dialect.name == 'sqlite'
+
+def index_post(post):
+    if search_available():
+        db.session.execute(text("INSERT INTO post_search(rowid, title, content, post_id) VALUES (:rowid, :title, :content, :post_id)"),
+                           {"rowid": -post.id, "title": post.title, "content": post.content, "post_id": post.id})
+
+def index_comment(comment):
+    if search_available():
+        db.session.execute(text("INSERT INTO post_search(rowid, title, content, post_id) VALUES (:rowid, '', :content, :post_id)"),
+                           {"rowid": comment.id, "content": comment.content, "post_id": comment.post_id})
+
+def unindex_post(post_id):
+    """Remove a post and its comments from the search index; call before deleting the comments."""
+    if search_available():
+        db.session.execute(text("DELETE FROM post_search WHERE rowid = :rowid OR rowid IN (SELECT id FROM comment WHERE post_id = :post_id)"),
+                           {"rowid": -post_id, "post_id": post_id})
+
+def rebuild_search_index():
+    db.session.execute(text("DELETE FROM post_search"))
+    db.session.execute(text("INSERT INTO post_search(rowid, title, content, post_id) "
+                            "SELECT -id, title, content, id FROM post WHERE deleted_at IS NULL"))
+    db.session.execute(text("INSERT INTO post_search(rowid, title, content, post_id) "
+                            "SELECT comment.id, '', comment.content, comment.post_id FROM comment "
+                            "JOIN post ON post.id = comment.post_id WHERE post.deleted_at IS NULL"))
+    db.session.execute(text("INSERT INTO post_search(post_search) VALUES ('optimize')"))
+    db.session.commit()
+
+def to_match_query(query):
+    # Quote every term so user input can't break FTS5 query syntax; terms are ANDed
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+def highlight_snippet(snippet):
+    # snippet() marks hits with \x02/\x03; escape the user text before turning them into tags
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_posts(query, page=1):
+    """Return (results, has_more) for one page of BM25-ranked matches."""
+    limit = app.config['SEARCH_PAGE_SIZE']
+    offset = (page - 1) * limit
+    if not search_available():
+        # Substring match, newest first, over posts and comments alike; the query is matched literally
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        matches = db.union_all(
+            db.select(Post.id.label('post_id'), db.null().label('comment_id'), Post.created_at, Post.content)
+            .where(Post.deleted_at.is_(None), db.or_(Post.title.ilike(pattern, escape="\\"), Post.content.ilike(pattern, escape="\\"))),
+            db.select(Comment.post_id, Comment.id, Comment.created_at, Comment.content)
+            .join(Post, Post.id == Comment.post_id)
+            .where(Post.deleted_at.is_(None), Comment.content.ilike(pattern, escape="\\")),
+        ).subquery()
+        rows = db.session.execute(db.select(matches).order_by(matches.c.created_at.desc(), matches.c.post_id.desc(), matches.c.comment_id.desc())
+                                  .offset(offset).limit(limit + 1)).all()
+        posts = {post.id: post for post in Post.query.filter(Post.id.in_({row.post_id for row in rows}))}
+        results = [{"post": posts[row.post_id], "comment_id": row.comment_id, "snippet": row.content[:200]} for row in rows[:limit]]
+        return results, len(rows) > limit
+
+    rows = db.session.execute(text(
+        "SELECT rowid, post_id, snippet(post_search, -1, char(2), char(3), '…', 16) AS snippet "
+        "FROM post_search WHERE post_search MATCH :match "
+        "ORDER BY bm25(post_search, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+    ), {"match": to_match_query(query), "limit": limit + 1, "offset": offset}).all()
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_({row.post_id for row in rows}), Post.deleted_at.is_(None))}
+    results = [{
+        "post": posts[row.post_id],
+        "comment_id": row.rowid if row.rowid > 0 else None,
+        "snippet": highlight_snippet(row.snippet)
+    } for row in rows[:limit] if row.post_id in posts]
+    return results, len(rows) > limit
+
+HOT_SCORE_EPOCH = datetime(2024, 1, 1)
+
+def compute_hot_score(likes, comments, created_at):
+    """Reddit-style rank: log10 of engagement plus a bonus that grows with creation time.
+
+    Newer posts get a higher baseline, so older posts decay relative to them
+    without their stored score ever having to change.
+    """
+    engagement = max((likes or 0) + (comments or 0), 1)
+    return round(math.log10(engagement) + (created_at - HOT_SCORE_EPOCH).total_seconds() / app.config['HOT_SCORE_GRAVITY'], 7)
+
+def record_comment(comment):
+    """Insert a comment and bump the thread counters it affects; the caller refreshes the hot score and commits."""
+    comment.created_at = comment.created_at or datetime.utcnow()
+    db.session.add(comment)
+    db.session.flush()
+    index_comment(comment)
+    Post.query.filter_by(id=comment.post_id).update(
+        {Post.comment_count: Post.comment_count + 1,
+         Post.changed_at: datetime.utcnow(),
+         Post.last_activity_at: db.case((Post.last_activity_at > comment.created_at, Post.last_activity_at),
+                                        else_=comment.created_at)},
+        synchronize_session=False)
+    if comment.parent_id:
+        Comment.query.filter_by(id=comment.parent_id).update({Comment.reply_count: Comment.reply_count + 1}, synchronize_session=False)
+
+def update_hot_score(post_id):
+    row = db.session.query(Post.likes, Post.comment_count, Post.created_at).filter(Post.id == post_id).first()
+    if row:
+        Post.query.filter_by(id=post_id).update({Post.hot_score: compute_hot_score(*row)}, synchronize_session=False)
+
+def refresh_hot_scores(days=None):
+    """Recompute hot scores of recent (or unscored) posts from their likes and comments."""
+    cutoff = datetime.utcnow() - timedelta(days=days or app.config['HOT_REFRESH_WINDOW_DAYS'])
+    rows = (db.session.query(Post.id, Post.likes, Post.created_at, Post.comment_count)
+            .filter(Post.deleted_at.is_(None), db.or_(Post.created_at >= cutoff, Post.hot_score.is_(None))).all())
+    if rows:
+        db.session.execute(db.update(Post), [
+            {"id": post_id, "hot_score": compute_hot_score(likes, count, created_at)}
+            for post_id, likes, created_at, count in rows
+        ])
+        db.session.commit()
+    return len(rows)
+
+# Feed orderings: sort key column and how it is written into a cursor
+FEED_SORTS = {
+    'new': (Post.created_at, lambda value: value.strftime('%Y%m%d%H%M%S%f'), lambda text: datetime.strptime(text, '%Y%m%d%H%M%S%f')),
+    'hot': (Post.hot_score, repr, float),
+    'top': (Post.likes, str, int),
+    'active': (Post.last_activity_at, lambda value: value.strftime('%Y%m%d%H%M%S%f'), lambda text: datetime.strptime(text, '%Y%m%d%H%M%S%f')),
+}
+TOP_WINDOWS = {'day': timedelta(days=1), 'week': timedelta(weeks=1), 'all': None}
+
+def encode_cursor(post, sort='new'):
+    column, encode, decode = FEED_SORTS[sort]
+    return f"{encode(getattr(post, column.key))}_{post.id}"
+
+def decode_cursor(cursor, sort='new'):
+    column, encode, decode = FEED_SORTS[sort]
+    try:
+        value, post_id = cursor.rsplit('_', 1)
+        return decode(value), int(post_id)
+    except (AttributeError, ValueError):
+        return None
+
+def get_feed_page(cursor=None, limit=None, sort='new', window='all'):
+    """Return (posts, next_cursor) for one page of the feed.
+
+    Uses keyset pagination on (sort key, id) so every page is an index
+    range scan no matter how deep the client has scrolled. "top" feeds for
+    a day or week only rank the posts created inside that window.
+    """
+    query, limit = feed_query(cursor, limit, sort, window)
+    posts = query.all()
+    next_cursor = encode_cursor(posts[limit - 1], sort) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+def feed_query(cursor=None, limit=None, sort='new', window='all'):
+    """Build the query for one feed page; it fetches one extra row to detect a next page."""
+    limit = max(1, min(limit or app.config['FEED_PAGE_SIZE'], app.config['FEED_MAX_PAGE_SIZE']))
+    column = FEED_SORTS[sort][0]
+    query = Post.query.filter(Post.deleted_at.is_(None))
+    if sort in ('hot', 'active'):
+        query = query.filter(column.isnot(None))
+    if sort == 'top' and TOP_WINDOWS.get(window):
+        query = query.filter(Post.created_at >= datetime.utcnow() - TOP_WINDOWS[window])
+        # Range-scan the window on ix_post_created_at_id and sort those few rows; ordering by the
+        # bare column would walk ix_post_likes_id over all history until the page fills up
+        column = column + 0
+    position = decode_cursor(cursor, sort) if cursor else None
+    if position:
+        value, post_id = position
+        query = query.filter(db.or_(column < value, db.and_(column == value, Post.id < post_id)))
+    return query.order_by(column.desc(), Post.id.desc()).limit(limit + 1), limit
+
+def get_feed_args():
+    sort = request.args.get('sort', 'new')
+    sort = sort if sort in FEED_SORTS else 'new'
+    window = request.args.get('t', 'day' if sort == 'top' else 'all')
+    window = window if window in TOP_WINDOWS else 'all'
+    return sort, window
+
+class StreamedFeedPage:
+    """Feed page that yields (post, liked) while rows come off the database cursor.
+
+    Like state is fetched per chunk of STREAM_CHUNK_ROWS posts. next_cursor is
+    only known once iteration has finished, so templates read it after the loop.
+    """
+
+    def __init__(self, cursor=None, limit=None, sort='new', window='all'):
+        self.query, self.limit = feed_query(cursor, limit, sort, window)
+        self.sort = sort
+        self.next_cursor = None
+
+    def _flush(self, chunk):
+        liked_ids = get_liked_post_ids(post.id for post in chunk)
+        return [(post, post.id in liked_ids) for post in chunk]
+
+    def __iter__(self):
+        chunk_rows = app.config['STREAM_CHUNK_ROWS']
+        chunk = []
+        last_post = None
+        for count, post in enumerate(self.query.yield_per(chunk_rows)):
+            if count == self.limit:
+                self.next_cursor = encode_cursor(last_post, self.sort)
+                break
+            chunk.append(post)
+            last_post = post
+            if len(chunk) == chunk_rows:
+                yield from self._flush(chunk)
+                chunk = []
+        yield from self._flush(chunk)
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed response, flushing every STREAM_BUFFER_SIZE pieces."""
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+    return Response(stream_with_context(timed_pieces(stream)), mimetype='text/html')
+
+def get_macros():
+    return app.jinja_env.get_template('_macros.html').module
+
+# Placeholders for the per-user parts of a cached post. Autoescaping turns any
+# "<" in user content into "&lt;", so these can only come from the templates.
+HEART_SLOT = Markup('<heart-slot>')
+DELETE_SLOT = Markup('<delete-slot>')
+
+def overlay_user_state(html, post, liked):
+    delete_button = get_macros().delete_button(post.id) if session.get('username') == post.author else ''
+    return Markup(html.replace(HEART_SLOT, 'fas text-blue-500' if liked else 'far').replace(DELETE_SLOT, delete_button))
+
+@app.template_global()
+def render_post_card(post, liked):
+    html = fragment_cache.get_or_render('post', post.id, post.changed_at, lambda: get_macros().post_card(post, HEART_SLOT, DELETE_SLOT), 'card')
+    return overlay_user_state(html, post, liked)
+
+def render_post_detail(post, liked):
+    html = fragment_cache.get_or_render('post', post.id, post.changed_at, lambda: get_macros().post_detail(post, HEART_SLOT, DELETE_SLOT), 'detail')
+    return overlay_user_state(html, post, liked)
+
+def comment_sort_key(rank, dialect):
+    # Zero-padded sibling rank; a node's path sorts right before its replies' paths
+    if dialect == 'sqlite':
+        return db.func.printf('%010d', rank, type_=db.String)
+    return db.func.lpad(db.cast(rank, db.String), 10, '0', type_=db.String)
+
+def comment_tree_query(post_id, parent_id=None, offset=0, dialect='sqlite'):
+    """Select the visible replies of parent_id in display order with one recursive CTE.
+
+    Each row carries its depth, its rank and count among its siblings, and its
+    stored reply count, which is all the renderer needs to place the "continue
+    this thread" links without holding the tree in memory. Branches deeper
+    than COMMENT_MAX_DEPTH and siblings past COMMENT_MAX_CHILDREN are cut off.
+    """
+    max_depth = app.config['COMMENT_MAX_DEPTH']
+    max_children = app.config['COMMENT_MAX_CHILDREN']
+    ranked = db.select(
+        Comment.id,
+        Comment.parent_id,
+        db.func.row_number().over(partition_by=Comment.parent_id, order_by=(Comment.created_at, Comment.id)).label('rank'),
+        db.func.count().over(partition_by=Comment.parent_id).label('siblings'),
+    ).where(Comment.post_id == post_id).cte('ranked')
+    tree = db.select(
+        ranked.c.id, db.literal(0).label('depth'), comment_sort_key(ranked.c.rank, dialect).label('path'), ranked.c.rank, ranked.c.siblings
+    ).where(
+        ranked.c.parent_id.is_(None) if parent_id is None else ranked.c.parent_id == parent_id,
+        ranked.c.rank > offset,
+        ranked.c.rank <= offset + max_children,
+    ).cte('tree', recursive=True)
+    child = ranked.alias('child')
+    tree = tree.union_all(db.select(
+        child.c.id, tree.c.depth + 1, tree.c.path + '.' + comment_sort_key(child.c.rank, dialect), child.c.rank, child.c.siblings
+    ).where(child.c.parent_id == tree.c.id, tree.c.depth + 1 < max_depth, child.c.rank <= max_children))
+    return (db.select(Comment.id, Comment.parent_id, Comment.author, Comment.content, Comment.created_at,
+                      tree.c.depth, tree.c.rank, tree.c.siblings, Comment.reply_count.label('replies'))
+            .join(tree, tree.c.id == Comment.id)
+            .order_by(tree.c.path))
+
+def render_thread_link(post_id, comment_id, text, offset=0):
+    url = url_for('view_thread', post_id=post_id, comment_id=comment_id, offset=offset or None)
+    return get_macros().thread_link(url, text)
+
+def iter_comment_tree(post_id, parent_id=None, offset=0, session=None):
+    """Yield the HTML of a comment tree piece by piece as rows are read.
+
+    Rows arrive depth-first, so only the chain of currently open comments is
+    kept: memory is bounded by thread depth, not size, and nothing recurses.
+    The tree is read through session, the app's own by default.
+    """
+    session = session or db.session
+    max_depth = app.config['COMMENT_MAX_DEPTH']
+    max_children = app.config['COMMENT_MAX_CHILDREN']
+    macros = get_macros()
+    comment_close = macros.comment_close()
+
+    def close(node):
+        if node.replies and node.depth + 1 >= max_depth:
+            yield render_thread_link(post_id, node.id, "Продолжить ветку →")
+        yield comment_close
+        # After the last visible sibling, link to the ones that were cut off
+        shown = (offset if node.depth == 0 else 0) + max_children
+        if node.rank == min(node.siblings, shown) and node.siblings > shown:
+            yield render_thread_link(post_id, node.parent_id, f"Показать ещё ответы ({node.siblings - shown})", shown)
+
+    query = comment_tree_query(post_id, parent_id, offset, session.get_bind().dialect.name)
+    open_nodes = []
+    for row in session.execute(query.execution_options(yield_per=app.config['STREAM_CHUNK_ROWS'])):
+        while open_nodes and open_nodes[-1].depth >= row.depth:
+            yield from close(open_nodes.pop())
+        yield macros.comment_open(row, post_id)
+        open_nodes.append(row)
+    while open_nodes:
+        yield from close(open_nodes.pop())
+
+def render_comment_tree(post_id, parent_id=None, offset=0, session=None):
+    with render_timer():
+        return Markup("".join(iter_comment_tree(post_id, parent_id, offset, session)))
+
+def comment_tree_chunks(post, parent_id=None, offset=0):
+    """Comment tree HTML for a page: a cached copy if there is one, else streamed or rendered and cached."""
+    post_id = post.id
+    html = fragment_cache.get('thread', post_id, post.changed_at, parent_id, offset)
+    if html is not None:
+        return [Markup(html)] if html else []
+    if app.config['STREAMING_RENDER']:
+        # Streamed pages don't fill the cache: that would buffer the whole thread
+        return timed_pieces(iter_comment_tree(post_id, parent_id, offset))
+    html = fragment_cache.get_or_render('thread', post_id, post.changed_at, lambda: render_comment_tree(post_id, parent_id, offset), parent_id, offset)
+    return [Markup(html)] if html else []
+
+def compile_templates():
+    """Compile every named template once at startup so requests only render them."""
+    if app.config['TEMPLATE_BYTECODE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR'])
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+compile_templates()
+
+class AssetManifest:
+    """Static files fingerprinted by content hash and precompressed at startup.
+
+    Files are addressed by their path under the static directory; templates link
+    to the fingerprinted name (css/app.3f2a9c1b0d4e.css), which is served as
+    immutable, while the plain name stays revalidatable with the same strong ETag.
+    """
+    COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}
+        self.urls = {}
+
+    def load(self):
+        entries, urls = {}, {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                logical = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if logical.endswith(('.gz', '.br')):
+                    continue
+                with open(path, 'rb') as f:
+                    body = f.read()
+                digest = hashlib.sha256(body).hexdigest()
+                stem, ext = os.path.splitext(logical)
+                mimetype = mimetypes.guess_type(logical)[0] or 'application/octet-stream'
+                variants = {'identity': body}
+                if mimetype.startswith(self.COMPRESSIBLE):
+                    variants['gzip'] = gzip.compress(body, 9, mtime=0)
+                    if brotli is not None:
+                        variants['br'] = brotli.compress(body)
+                entry = {'name': f"{stem}.{digest[:12]}{ext}", 'etag': digest[:32], 'mimetype': mimetype, 'variants': variants}
+                entries[logical] = entries[entry['name']] = entry
+                urls[logical] = entry['name']
+        self.entries, self.urls = entries, urls
+
+    def url_name(self, logical):
+        return self.urls.get(logical, logical)
+
+    def response(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None:
+            abort(404)
+        encoding = next((e for e in ('br', 'gzip') if e in entry['variants'] and e in request.accept_encodings), 'identity')
+        response = Response(entry['variants'][encoding], mimetype=entry['mimetype'])
+        # Each encoding is a different byte sequence, so it gets its own strong ETag
+        response.set_etag(entry['etag'] if encoding == 'identity' else f"{entry['etag']}-{encoding}")
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        if filename == entry['name']:
+            response.cache_control.max_age = app.config['ASSET_MAX_AGE']
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+assets = AssetManifest(os.path.join(app.root_path, 'static'))
+assets.load()
+
+@app.template_global()
+def asset_url(path):
+    return url_for('asset', filename=assets.url_name(path))
+
+@app.template_global()
+def asset_exists(path):
+    return path in assets.urls
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    return assets.response(filename)
 
 @app.route('/serve_image/<filename>')
 def serve_image(filename):
-    return send_from_directory(os.path.dirname(__file__), filename)
+    # Kept for old links; only files from the static directory are served
+    return assets.response(filename)
+
+def compute_render_version():
+    # Pages change with a deploy even when the data does not, so templates and assets are part of every ETag
+    digest = hashlib.sha256()
+    for name in sorted(app.jinja_env.list_templates()):
+        digest.update(app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode())
+    digest.update(repr(sorted(assets.urls.items())).encode())
+    return digest.hexdigest()[:16]
+
+RENDER_VERSION = compute_render_version()
+
+def feed_validators(sort, window):
+    """(ETag parts, Last-Modified) for feed pages, read from two indexed columns in one statement.
+
+    Every change shown on a post card bumps Post.changed_at and hard deletes
+    leave a tombstone, so the pair moves whenever any feed page could.
+    """
+    changed_at, tombstone = db.session.execute(db.select(
+        db.select(db.func.max(Post.changed_at)).scalar_subquery(),
+        db.select(db.func.max(PostTombstone.id)).scalar_subquery())).one()
+    parts = (changed_at, tombstone)
+    if sort == 'top' and TOP_WINDOWS.get(window):
+        # Posts age out of windowed feeds without any write, so those pages expire every minute
+        parts += (int(time.time() // 60),)
+    return parts, changed_at
+
+def conditional_response(last_modified, render, *parts):
+    """Answer 304 if the client's validators match this user's view of the data, else call render()."""
+    etag = hashlib.sha1(repr((RENDER_VERSION, get_user_id(), request.full_path) + parts).encode()).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Pages are per user: browsers may keep them but must revalidate, shared caches must not store them
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/')
 def index():
     if not is_logged_in():
         return redirect(url_for('login'))
-    posts = Post.query.order_by(Post.created_at.desc()).all()
-    posts_html = "".join(
-        f"""
-        <div class='post-container'>
-            <h2 class='text-xl font-semibold post-title'><a href='{url_for('view_post', post_id=post.id)}' class="nav-link">{post.title}</a></h2>
-            <p class='mt-2 post-content'>{post.content}</p>
-            <div class='flex justify-between items-center mt-4'>
-                <p class='text-sm text-blue-300'>Автор: {post.author} | {post.created_at.strftime('%d.%m.%Y %H:%M')}</p>
-                <div class='flex items-center'>
-                    <button id="like-btn-{post.id}" onclick="likePost({post.id})" class="mr-1 text-blue-300 hover:text-blue-500">
-                        <i class="{'fas text-blue-500' if user_liked_post(post.id) else 'far'} fa-heart"></i>
-                    </button>
-                    <span id="like-count-{post.id}" class="text-blue-300">{post.likes}</span>
-                    <a href="{url_for('view_post', post_id=post.id)}" class="ml-4 text-blue-500 nav-link">
-                        Комментарии
-                    </a>
-                    {f'<button onclick="deletePost({post.id})" class="ml-4 text-red-500"><i class="fas fa-trash"></i></button>' if session.get('username') == post.author else ''}
-                </div>
-            </div>
-        </div>
-        """ for post in posts
-    )
-    return render_template_string(base_html, title="Главная", content=posts_html)
+    sort, window = get_feed_args()
+    parts, last_modified = feed_validators(sort, window)
+    render = stream_page if app.config['STREAMING_RENDER'] else render_template
+    return conditional_response(last_modified, lambda: render(
+        'index.html', title="Главная", sort=sort, window=window,
+        feed=StreamedFeedPage(request.args.get('cursor'), request.args.get('limit', type=int), sort, window)), *parts)
+
+@app.route('/feed.json')
+def feed_json():
+    if not is_logged_in():
+        return jsonify({"success": False, "error": "Необходимо войти"}), 401
+    sort, window = get_feed_args()
+    parts, last_modified = feed_validators(sort, window)
+    return conditional_response(last_modified, lambda: feed_json_body(sort, window), *parts)
+
+def feed_json_body(sort, window):
+    posts, next_cursor = get_feed_page(request.args.get('cursor'), request.args.get('limit', type=int), sort, window)
+    liked_ids = get_liked_post_ids(post.id for post in posts)
+    return jsonify({
+        "success": True,
+        "posts": [{
+            "id": post.id,
+            "title": post.title,
+            "content": post.content,
+            "author": post.author,
+            "created_at": post.created_at.isoformat(),
+            "likes": post.likes,
+            "liked": post.id in liked_ids
+        } for post in posts],
+        "html": "".join(render_post_card(post, post.id in liked_ids) for post in posts),
+        "next_cursor": next_cursor
+    })
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -359,44 +1261,16 @@ def register():
         elif User.query.filter_by(username=username).first():
             return jsonify({"success": False, "message": "Пользователь уже существует."})
         else:
-            hashed_pw = generate_password_hash(password)
+            hashed_pw = password_hasher.hash(password)
             new_user = User(username=username, password=hashed_pw)
             db.session.add(new_user)
             db.session.commit()
 
             # Automatically log in the user after registration
-            session['username'] = new_user.username
+            login_session(new_user)
             return jsonify({"success": True, "message": "Аккаунт успешно создан!", "redirect": url_for('index')})
 
-    return render_template_string(base_html, title="Регистрация", content=render_register_form(error), notification=notification)
-
-def render_register_form(error):
-    return f"""
-    <div class="bg-blue-900 p-6 rounded-xl shadow-md max-w-md mx-auto">
-        <h2 class="text-xl font-bold mb-4 text-blue-200">Регистрация</h2>
-        {"<p class='text-red-400 mb-2'>" + error + "</p>" if error else ""}
-        <form method="post" class="space-y-4" onsubmit="registerUser(event)">
-            <input name="username" class="w-full p-2 border rounded bg-blue-800 text-blue-100" placeholder="Имя пользователя">
-            <input type="password" name="password" class="w-full p-2 border rounded bg-blue-800 text-blue-100" placeholder="Пароль">
-            <button class="bg-blue-600 text-white px-4 py-2 rounded w-full hover:bg-blue-500">Зарегистрироваться</button>
-        </form>
-        <p class="mt-4 text-sm text-blue-300">Уже есть аккаунт? <a href="{url_for('login')}" class="text-blue-400 nav-link">Войти</a></p>
-    </div>
-    """
-
-def render_login_form(error):
-    return f"""
-    <div class="bg-blue-900 p-6 rounded-xl shadow-md max-w-md mx-auto">
-        <h2 class="text-xl font-bold mb-4 text-blue-200">Вход</h2>
-        {"<p class='text-red-400 mb-2'>" + error + "</p>" if error else ""}
-        <form method="post" class="space-y-4" onsubmit="loginUser(event)">
-            <input name="username" class="w-full p-2 border rounded bg-blue-800 text-blue-100" placeholder="Имя пользователя">
-            <input type="password" name="password" class="w-full p-2 border rounded bg-blue-800 text-blue-100" placeholder="Пароль">
-            <button class="bg-blue-600 text-white px-4 py-2 rounded w-full hover:bg-blue-500">Войти</button>
-        </form>
-        <p class="mt-4 text-sm text-blue-300">Нет аккаунта? <a href="{url_for('register')}" class="text-blue-400 nav-link">Зарегистрироваться</a></p>
-    </div>
-    """
+    return render_template('register.html', title="Регистрация", error=error, notification=notification)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -414,25 +1288,28 @@ def login():
             return jsonify({"success": False, "message": "Пожалуйста, заполните все поля."})
         else:
             user = User.query.filter_by(username=username).first()
-            if user and check_password_hash(user.password, password):
-                session['username'] = user.username
+            if user and password_hasher.check(user.password, password):
+                if password_needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
+                login_session(user)
                 return jsonify({"success": True, "message": "Успешный вход!", "redirect": url_for('index')})
             else:
                 return jsonify({"success": False, "message": "Неверные имя пользователя или пароль."})
 
-    return render_template_string(base_html, title="Вход", content=render_login_form(error), notification=notification)
+    return render_template('login.html', title="Вход", error=error, notification=notification)
 
 @app.route('/logout')
 def logout():
     if 'username' in session:
-        session.pop('username', None)
+        logout_session()
         # Использование flask.flash требует конфигурации приложения,
         # поэтому мы используем перенаправление с уведомлением через параметр запроса
         return redirect(url_for('login') + '?logged_out=1')
     return redirect(url_for('login'))
 
 @app.route('/create', methods=['GET', 'POST'])
-@limiter.limit("1/10seconds")  # Limit to 1 request per 10 seconds
+@limiter.limit("1/10seconds", error_message="Похоже На Спам! Лимит-1 публикация раз в 10 секунд!")  # Limit to 1 request per 10 seconds
 def create_post():
     if not is_logged_in():
         return redirect(url_for('login'))
@@ -445,103 +1322,106 @@ def create_post():
         if not title or not content:
             return jsonify({"success": False, "message": "Заполните все поля."})
         else:
-            post = Post(title=title, content=content, author=session['username'])
+            now = datetime.utcnow()
+            post = Post(title=title, content=content, author=session['username'], created_at=now,
+                        last_activity_at=now, changed_at=now, hot_score=compute_hot_score(0, 0, now))
             db.session.add(post)
+            db.session.flush()
+            index_post(post)
             db.session.commit()
             return jsonify({"success": True, "message": "Пост успешно создан!", "redirect": url_for('index')})
 
-    form = f"""
-    <div class="bg-blue-900 p-6 rounded-xl shadow-md max-w-md mx-auto">
-        <h2 class="text-xl font-bold mb-4 text-blue-200">Новый пост</h2>
-        {"<p class='text-red-400 mb-2'>" + error + "</p>" if error else ""}
-        <form method="post" class="space-y-4" onsubmit="createPost(event)">
-            <input name="title" class="w-full p-2 border rounded bg-blue-800 text-blue-100" placeholder="Заголовок">
-            <textarea name="content" class="w-full p-2 border rounded h-32 bg-blue-800 text-blue-100" placeholder="Содержание..."></textarea>
-            <button class="bg-blue-600 text-white px-4 py-2 rounded w-full hover:bg-blue-500">Опубликовать</button>
-        </form>
-    </div>
-    """
-    return render_template_string(base_html, title="Создать пост", content=form, notification=notification)
+    return render_template('create.html', title="Создать пост", error=error, notification=notification)
+
+@app.errorhandler(ServiceBusy)
+def service_busy_handler(e):
+    response = jsonify({"success": False, "message": "Сервер перегружен, попробуйте через несколько секунд."})
+    response.headers['Retry-After'] = '5'
+    return response, 503
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
-    return render_template_string(base_html, title="Похоже На Спам!", content="""
-    <div class="bg-blue-900 p-6 rounded-xl shadow-md max-w-md mx-auto">
-        <h2 class="text-xl font-bold mb-4 text-blue-200">Похоже На Спам!</h2>
-        <p class="text-blue-300">Лимит-1 публикация раз в 10 секунд!</p>
-    </div>
-    """)
+    return render_template('ratelimit.html', title="Похоже На Спам!")
+
+@app.route('/search')
+def search():
+    if not is_logged_in():
+        return redirect(url_for('login'))
+
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = search_posts(query, page) if query else ([], False)
+    return render_template('search.html', title="Поиск", query=query, page=page, results=results, has_more=has_more)
+
+@lru_cache(maxsize=None)
+def archive_engine(path, readonly=True):
+    if readonly:
+        return create_engine(f"sqlite:///file:{path}?mode=ro&uri=true")
+    return create_engine(f"sqlite:///{path}")
+
+def archive_reader():
+    """Read-only engine on the archive file, or None while nothing has been archived."""
+    path = app.config['ARCHIVE_PATH']
+    return archive_engine(path) if os.path.exists(path) else None
+
+def view_archived(post_id, comment_id=None, offset=0, thread=False):
+    """Serve a post page or one of its thread pages from the archive, which is read-only."""
+    engine = archive_reader()
+    if engine is None:
+        abort(404)
+    with Session(engine) as archive:
+        post = archive.get(Post, post_id)
+        comment = None if comment_id is None else archive.query(Comment).filter_by(id=comment_id, post_id=post_id).first()
+        if post is None or (comment_id is not None and comment is None):
+            abort(404)
+
+        def render():
+            replies = render_comment_tree(post_id, comment_id, offset, archive)
+            chunks = [replies] if replies else []
+            if not thread:
+                liked = archive.query(Like.id).filter_by(post_id=post_id, user_id=get_user_id()).first() is not None
+                return render_template('post.html', title=post.title, post=post, post_html=render_post_detail(post, liked),
+                                       comments=chunks, archived=True)
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+                return Response(replies, mimetype='text/html')
+            return render_template('thread.html', title="Ветка комментариев", post_id=post_id, comment=comment, replies=chunks)
+
+        return conditional_response(post.changed_at, render, post.changed_at, 'archived')
 
 @app.route('/post/<int:post_id>')
 def view_post(post_id):
     if not is_logged_in():
         return redirect(url_for('login'))
 
-    post = Post.query.get_or_404(post_id)
-    comments = Comment.query.filter_by(post_id=post_id, parent_id=None).order_by(Comment.created_at).all()
-
-    def render_comments(comments):
-        comments_html = ""
-        for comment in comments:
-            replies = Comment.query.filter_by(parent_id=comment.id).order_by(Comment.created_at).all()
-            replies_html = render_comments(replies) if replies else ""
-            comments_html += f"""
-            <div class="comment-container">
-                <div class="flex items-center">
-                    <span class="font-medium text-blue-200">{comment.author}</span>
-                    <span class="text-xs text-blue-300 ml-2">{comment.created_at.strftime('%d.%m.%Y %H:%M')}</span>
-                </div>
-                <p class="mt-1 comment-content">{comment.content}</p>
-                <div class="ml-4 mt-2">
-                    <a href="#" onclick="toggleReplyForm({comment.id}); return false;" class="text-blue-500 nav-link text-sm">Ответить</a>
-                    <div id="reply-form-{comment.id}" class="hidden mt-2">
-                        <form action="{url_for('add_comment', post_id=post.id)}" method="post" class="flex flex-col gap-2">
-                            <input type="hidden" name="parent_id" value="{comment.id}">
-                            <textarea name="content" class="w-full p-2 border rounded h-24 bg-blue-900 text-gray-200" placeholder="Добавить ответ..."></textarea>
-                            <button class="bg-blue-500 text-white px-4 py-2 rounded self-end hover:bg-blue-600">Отправить</button>
-                        </form>
-                    </div>
-                </div>
-                <div class="ml-4 mt-2">
-                    {replies_html}
-                </div>
-            </div>
-            """
-        return comments_html
-
-    comments_html = render_comments(comments)
-
-    content = f"""
-    <div class="post-container">
-        <h1 class="text-2xl font-bold post-title mb-2">{post.title}</h1>
-        <p class="mb-4 post-content">{post.content}</p>
-        <div class="flex justify-between items-center mb-6">
-            <p class="text-sm text-blue-300">Автор: {post.author} | {post.created_at.strftime('%d.%m.%Y %H:%M')}</p>
-            <div class="flex items-center">
-                <button id="like-btn-{post.id}" onclick="likePost({post.id})" class="mr-1 text-blue-300 hover:text-blue-500">
-                    <i class="{'fas text-blue-500' if user_liked_post(post.id) else 'far'} fa-heart"></i>
-                </button>
-                <span id="like-count-{post.id}" class="text-blue-300">{post.likes}</span>
-                {f'<button onclick="deletePost({post.id})" class="ml-4 text-red-500"><i class="fas fa-trash"></i></button>' if session.get('username') == post.author else ''}
-            </div>
-        </div>
-
-        <div class="mt-8">
-            <h3 class="text-xl font-semibold mb-4">Комментарии</h3>
-            <div class="mb-6">
-                <form action="{url_for('add_comment', post_id=post.id)}" method="post" class="flex flex-col gap-2">
-                    <textarea name="content" class="w-full p-2 border rounded h-24 bg-blue-900 text-gray-200" placeholder="Добавить комментарий..."></textarea>
-                    <button class="bg-blue-500 text-white px-4 py-2 rounded self-end hover:bg-blue-600">Отправить</button>
-                </form>
-            </div>
-            <div class="space-y-4">
-                {comments_html if comments else "<p class='text-blue-300'>Пока нет комментариев</p>"}
-            </div>
-        </div>
-    </div>
-    """
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first()
+    if post is None:
+        return view_archived(post_id)
+    render = stream_page if app.config['STREAMING_RENDER'] else render_template
+    return conditional_response(post.changed_at, lambda: render(
+        'post.html', title=post.title, post=post, post_html=render_post_detail(post, user_liked_post(post.id)),
+        comments=comment_tree_chunks(post)), post.changed_at)
+
+@app.route('/post/<int:post_id>/thread', defaults={'comment_id': None})
+@app.route('/post/<int:post_id>/thread/<int:comment_id>')
+def view_thread(post_id, comment_id):
+    if not is_logged_in():
+        return redirect(url_for('login'))
 
-    return render_template_string(base_html, title=post.title, content=content)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    post = Post.query.filter_by(id=post_id, deleted_at=None).first()
+    if post is None:
+        return view_archived(post_id, comment_id, offset, thread=True)
+    comment = None if comment_id is None else Comment.query.filter_by(id=comment_id, post_id=post_id).first_or_404()
+
+    # "Continue this thread" links lazy-load just the replies into the page
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return conditional_response(post.changed_at, lambda: Response(
+            stream_with_context(comment_tree_chunks(post, comment_id, offset)), mimetype='text/html'), post.changed_at, 'xhr')
+
+    render = stream_page if app.config['STREAMING_RENDER'] else render_template
+    return conditional_response(post.changed_at, lambda: render(
+        'thread.html', title="Ветка комментариев", post_id=post_id, comment=comment,
+        replies=comment_tree_chunks(post, comment_id, offset)), post.changed_at)
 
 @app.route('/post/<int:post_id>/comment', methods=['POST'])
 def add_comment(post_id):
@@ -555,7 +1435,7 @@ def add_comment(post_id):
         return redirect(url_for('view_post', post_id=post_id))
 
     # Проверка существования поста
-    post = Post.query.get_or_404(post_id)
+    post = get_post_or_404(post_id)
 
     # Проверка существования родительского комментария, если он указан
     if parent_id:
@@ -563,13 +1443,19 @@ def add_comment(post_id):
         if not parent_comment or parent_comment.post_id != post_id:
             return redirect(url_for('view_post', post_id=post_id))
 
+    if app.config['WRITE_BEHIND']:
+        write_behind.add_comment(content=content, author=session['username'], post_id=post_id,
+                                 parent_id=int(parent_id) if parent_id else None)
+        return redirect(url_for('view_post', post_id=post_id))
+
     comment = Comment(
         content=content,
         author=session['username'],
         post_id=post_id,
         parent_id=parent_id
     )
-    db.session.add(comment)
+    record_comment(comment)
+    update_hot_score(post_id)
     db.session.commit()
 
     return redirect(url_for('view_post', post_id=post_id))
@@ -583,54 +1469,56 @@ def like_post(post_id):
     if not user_id:
         return jsonify({"success": False, "error": "Пользователь не найден"}), 401
 
-    post = Post.query.get_or_404(post_id)
-
-    # Check if the user has already liked the post
-    like = Like.query.filter_by(user_id=user_id, post_id=post_id).first()
-
-    if like:
-        # If the like exists, remove it
-        db.session.delete(like)
-        post.likes -= 1
-        liked = False
-    else:
-        # If the like does not exist, add it
-        new_like = Like(user_id=user_id, post_id=post_id)
-        db.session.add(new_like)
-        post.likes += 1
-        liked = True
+    if app.config['WRITE_BEHIND']:
+        get_post_or_404(post_id)
+        liked, likes = write_behind.toggle_like(user_id, post_id)
+        return jsonify({"success": True, "likes": likes, "liked": liked})
 
+    # Toggle with set-based statements so concurrent likes never lose updates:
+    # the counter is incremented inside the database, not read into Python
+    try:
+        if Like.query.filter_by(user_id=user_id, post_id=post_id).delete():
+            delta = -1
+        else:
+            db.session.add(Like(user_id=user_id, post_id=post_id))
+            db.session.flush()
+            delta = 1
+        updated = Post.query.filter_by(id=post_id, deleted_at=None).update(
+            {Post.likes: Post.likes + delta, Post.changed_at: datetime.utcnow()}, synchronize_session=False)
+    except IntegrityError:
+        # A concurrent request from the same user inserted the like first
+        db.session.rollback()
+        delta = 1
+        updated = Post.query.filter_by(id=post_id, deleted_at=None).count()
+
+    if not updated:
+        db.session.rollback()
+        abort(404)
+    update_hot_score(post_id)
     db.session.commit()
 
-    return jsonify({"success": True, "likes": post.likes, "liked": liked})
+    liked = delta > 0
+    likes = db.session.query(Post.likes).filter_by(id=post_id).scalar()
+
+    return jsonify({"success": True, "likes": likes, "liked": liked})
 
 @app.route('/delete/<int:post_id>', methods=['POST'])
 def delete_post(post_id):
     if not is_logged_in():
         return jsonify({"success": False, "message": "Необходимо войти"}), 401
 
-    post = Post.query.get_or_404(post_id)
+    post = get_post_or_404(post_id)
 
     # Check if the current user is the author of the post
     if post.author != session['username']:
         return jsonify({"success": False, "message": "У вас нет прав для удаления этого поста"}), 403
 
-    # Delete all likes related to the post
-    Like.query.filter_by(post_id=post_id).delete()
-
-    # Delete all comments related to the post
-    # First delete child comments to avoid foreign key constraint issues
-    child_comments = Comment.query.filter(Comment.parent_id.isnot(None)).all()
-    for comment in child_comments:
-        if Comment.query.filter_by(id=comment.parent_id).first() and \
-           Comment.query.filter_by(id=comment.parent_id).first().post_id == post_id:
-            db.session.delete(comment)
-
-    # Then delete parent comments
-    Comment.query.filter_by(post_id=post_id).delete()
-
-    # Finally delete the post
-    db.session.delete(post)
+    unindex_post(post_id)
+    if app.config['POST_SOFT_DELETE']:
+        # Hide the post right away; purge_deleted_posts() removes the rows later
+        post.deleted_at = post.changed_at = datetime.utcnow()
+    else:
+        delete_post_rows(post_id)
     db.session.commit()
 
     return jsonify({
@@ -639,7 +1527,909 @@ def delete_post(post_id):
         "redirect": url_for('index')
     })
 
-if __name__ == '__main__':
+def delete_post_rows(post_id):
+    """Delete a post with its likes and whole comment thread in three statements."""
+    Like.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    Comment.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    Post.query.filter_by(id=post_id).delete(synchronize_session=False)
+    db.session.add(PostTombstone(post_id=post_id))
+
+def purge_deleted_posts(batch_size=None):
+    """Remove soft-deleted posts, committing every batch to keep write locks short."""
+    batch_size = batch_size or app.config['POST_PURGE_BATCH_SIZE']
+    post_ids = [row.id for row in db.session.query(Post.id).filter(Post.deleted_at.isnot(None))]
+    for post_id in post_ids:
+        for model in (Like, Comment):
+            while True:
+                # Replies always have higher ids than their parents, so deleting from
+                # the top keeps the parent_id foreign key satisfied after every batch
+                batch = db.select(model.id).where(model.post_id == post_id).order_by(model.id.desc()).limit(batch_size)
+                deleted = model.query.filter(model.id.in_(batch)).delete(synchronize_session=False)
+                db.session.commit()
+                if deleted < batch_size:
+                    break
+        Post.query.filter_by(id=post_id).delete(synchronize_session=False)
+        # The soft delete's changed_at bump leaves with the row; the tombstone keeps validators moving
+        db.session.add(PostTombstone(post_id=post_id))
+        db.session.commit()
+    return post_ids
+
+def reconcile_like_counts():
+    """Rebuild Post.likes from the Like table and return the ids that drifted."""
+    actual = db.select(db.func.count(Like.id)).where(Like.post_id == Post.id).scalar_subquery()
+    drifted = [row.id for row in db.session.query(Post.id).filter(db.or_(Post.likes.is_(None), Post.likes != actual))]
+    if drifted:
+        Post.query.filter(Post.id.in_(drifted)).update({Post.likes: actual, Post.changed_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+    return drifted
+
+def reconcile_thread_counts():
+    """Rebuild comment_count, last_activity_at and reply_count from the comment table.
+
+    Returns the number of posts and comments that had drifted.
+    """
+    comments = db.select(db.func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+    latest = db.select(db.func.max(Comment.created_at)).where(Comment.post_id == Post.id).scalar_subquery()
+    activity = db.func.coalesce(latest, Post.created_at)
+    drifted_posts = [row.id for row in db.session.query(Post.id).filter(db.or_(
+        Post.comment_count != comments, Post.last_activity_at.is_(None), Post.last_activity_at != activity))]
+    if drifted_posts:
+        Post.query.filter(Post.id.in_(drifted_posts)).update(
+            {Post.comment_count: comments, Post.last_activity_at: activity, Post.changed_at: datetime.utcnow()},
+            synchronize_session=False)
+    reply = db.aliased(Comment)
+    replies = db.select(db.func.count(reply.id)).where(reply.parent_id == Comment.id).scalar_subquery()
+    drifted_comments = (Comment.query.filter(Comment.reply_count != replies)
+                        .update({Comment.reply_count: replies}, synchronize_session=False))
+    db.session.commit()
+    for post_id in drifted_posts:
+        update_hot_score(post_id)
+    db.session.commit()
+    return len(drifted_posts), drifted_comments
+
+class WriteBehindQueue:
+    """Commits comments and like toggles from a background thread in group transactions.
+
+    Requests validate synchronously, enqueue the write and return. The author's
+    session records, per process, the sequence number of their last write and
+    how to recognise it in the database. Their next page view waits on the
+    sequence number when it lands on the process that queued the write, and
+    otherwise polls the database until the write is visible, so authors read
+    their writes on any worker (up to a 5 second wait).
+    Pending like state is overlaid on the database so toggles stay consistent
+    before they are flushed.
+    """
+
+    def __init__(self, interval_ms, batch_size, max_pending):
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.token = uuid.uuid4().hex
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._seq = 0
+        self._committed_seq = 0
+        self._pending_likes = {}
+        self._pending_deltas = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _enqueue(self, op):
+        self.start()
+        with self._lock:
+            self._seq += 1
+            op['seq'] = self._seq
+            try:
+                self._queue.put_nowait(op)
+            except queue.Full:
+                raise WriteQueueFull()
+            if op['kind'] == 'like':
+                self._pending_likes[(op['user_id'], op['post_id'])] = (op['liked'], op['seq'])
+                self._pending_deltas[op['post_id']] = self._pending_deltas.get(op['post_id'], 0) + op['delta']
+        # Batches commit in queue order, so once this write is visible so are the author's earlier ones here
+        pending = dict(session.get('pending_writes', {}))
+        pending[self.token] = (op['seq'], self._visibility_check(op))
+        session['pending_writes'] = pending
+        return op['seq']
+
+    @staticmethod
+    def _visibility_check(op):
+        if op['kind'] == 'comment':
+            fields = op['fields']
+            return ('comment', fields['post_id'], fields['author'], op['created_at'].isoformat())
+        return ('like', op['user_id'], op['post_id'], op['liked'])
+
+    def add_comment(self, **fields):
+        self._enqueue({'kind': 'comment', 'fields': fields, 'created_at': datetime.utcnow()})
+
+    def toggle_like(self, user_id, post_id):
+        """Flip the user's like on a post; returns (liked, likes) including pending writes."""
+        with self._lock:
+            pending = self._pending_likes.get((user_id, post_id))
+        if pending is not None:
+            currently_liked = pending[0]
+        else:
+            currently_liked = Like.query.filter_by(user_id=user_id, post_id=post_id).first() is not None
+        liked = not currently_liked
+        self._enqueue({'kind': 'like', 'user_id': user_id, 'post_id': post_id, 'liked': liked, 'delta': 1 if liked else -1})
+        # Read under the lock so a batch committing in between is not counted twice
+        with self._lock:
+            likes = db.session.query(Post.likes).filter_by(id=post_id).scalar() or 0
+            likes += self._pending_deltas.get(post_id, 0)
+        return liked, likes
+
+    def wait_for(self, seq, timeout=5):
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_seq >= seq, timeout)
+
+    def wait_visible(self, check, timeout=5):
+        """Poll until a write queued by another process is in the database; for cross-worker read-your-writes."""
+        if check[0] == 'comment':
+            _, post_id, author, created_at = check
+            visible = Comment.query.filter_by(post_id=post_id, author=author,
+                                              created_at=datetime.fromisoformat(created_at)).exists()
+        else:
+            _, user_id, post_id, liked = check
+            visible = Like.query.filter_by(user_id=user_id, post_id=post_id).exists()
+            if not liked:
+                visible = ~visible
+        deadline = time.monotonic() + timeout
+        while True:
+            done = db.session.query(visible).scalar()
+            # End the read so the next poll sees commits made since
+            db.session.rollback()
+            if done or time.monotonic() >= deadline:
+                return done
+            time.sleep(self.interval / 2)
+
+    def _apply(self, op):
+        if op['kind'] == 'comment':
+            record_comment(Comment(created_at=op['created_at'], **op['fields']))
+        elif op['liked']:
+            if not Like.query.filter_by(user_id=op['user_id'], post_id=op['post_id']).first():
+                db.session.add(Like(user_id=op['user_id'], post_id=op['post_id']))
+                Post.query.filter_by(id=op['post_id']).update(
+                    {Post.likes: Post.likes + 1, Post.changed_at: datetime.utcnow()}, synchronize_session=False)
+        elif Like.query.filter_by(user_id=op['user_id'], post_id=op['post_id']).delete():
+            Post.query.filter_by(id=op['post_id']).update(
+                {Post.likes: Post.likes - 1, Post.changed_at: datetime.utcnow()}, synchronize_session=False)
+
+    def _settle(self, batch):
+        # Drop the overlay for writes that are now in the database (or given up on); caller holds the lock
+        for op in batch:
+            if op['kind'] == 'like':
+                key = (op['user_id'], op['post_id'])
+                if self._pending_likes.get(key, (None, None))[1] == op['seq']:
+                    del self._pending_likes[key]
+                delta = self._pending_deltas.pop(op['post_id'], 0) - op['delta']
+                if delta:
+                    self._pending_deltas[op['post_id']] = delta
+
+    def _commit_batch(self, batch):
+        try:
+            for op in batch:
+                self._apply(op)
+            for post_id in {op['fields']['post_id'] if op['kind'] == 'comment' else op['post_id'] for op in batch}:
+                update_hot_score(post_id)
+            # Commit and settle atomically so a concurrent toggle never counts a like twice
+            with self._lock:
+                db.session.commit()
+                self._settle(batch)
+            return batch
+        except Exception:
+            db.session.rollback()
+            if len(batch) == 1:
+                app.logger.exception("Dropping write-behind %s that failed to commit", batch[0]['kind'])
+                with self._lock:
+                    self._settle(batch)
+                return []
+        # Isolate the failing write by committing the rest one by one
+        return [op for single in batch for op in self._commit_batch([single])]
+
+    def _finish(self, batch):
+        with self._lock:
+            self._committed_seq = max(self._committed_seq, max(op['seq'] for op in batch))
+            self._committed.notify_all()
+
+    def flush(self, block=True):
+        """Commit everything currently queued; returns the number of writes taken."""
+        batch = []
+        try:
+            batch.append(self._queue.get(block=block, timeout=self.interval if block else None))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if batch:
+            with app.app_context():
+                self._commit_batch(batch)
+                self._finish(batch)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            if self.flush() == self.batch_size:
+                continue
+            # Let writes accumulate for the rest of the interval to form a group commit
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def close(self):
+        while self.flush(block=False):
+            pass
+
+write_behind = WriteBehindQueue(app.config['WRITE_BEHIND_INTERVAL_MS'], app.config['WRITE_BEHIND_BATCH'], app.config['WRITE_BEHIND_MAX_PENDING'])
+
+@app.before_request
+def wait_for_own_writes():
+    # Read-your-writes: hold the author's next page view until their queued writes are committed;
+    # further writes only move the mark forward
+    # Checked before touching the session, which would add Vary: Cookie to every response,
+    # including the immutable assets shared caches should keep for everyone
+    if not app.config['WRITE_BEHIND'] or request.method != 'GET' or request.endpoint == 'asset':
+        return
+    pending = session.get('pending_writes')
+    if not pending:
+        return
+    for token, (seq, check) in pending.items():
+        if token == write_behind.token:
+            write_behind.wait_for(seq)
+        else:
+            # Queued by another worker, whose queue cannot be waited on from here
+            write_behind.wait_visible(check)
+    session.pop('pending_writes', None)
+
+class UpdateHub:
+    """Fans out like counts and new comment ids to the SSE subscribers of each post.
+
+    One poller thread per process reads all subscribed posts in one query per
+    tick, plus one per post with new comments, so database load does not grow
+    with the number of viewers.
+    Polling instead of hooking the write path also picks up writes committed
+    by other workers and by the write-behind queue.
+    """
+
+    def __init__(self, tick_ms, max_subscribers):
+        self.tick = tick_ms / 1000
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._count = 0
+        self._seen = {}
+        self._thread = None
+
+    def subscribe(self, post_id):
+        """Returns a queue of formatted SSE messages, or None when the process is at capacity."""
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            subscriber = queue.Queue(maxsize=16)
+            self._subscribers.setdefault(post_id, set()).add(subscriber)
+            self._count += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='live-updates', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, post_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(post_id, set())
+            if subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self._count -= 1
+            if not subscribers:
+                self._subscribers.pop(post_id, None)
+                self._seen.pop(post_id, None)
+
+    # Newest comment ids remembered per post. A comment that commits late with a lower id
+    # (ids come from a sequence at insert time) is still reported as long as fewer than
+    # this many newer comments on the same post were committed before it
+    COMMENT_LOOKBACK = 50
+
+    def poll(self):
+        with self._lock:
+            post_ids = list(self._subscribers)
+        if not post_ids:
+            return
+        # comment_count is updated in each comment's own transaction, so it changes exactly when
+        # new comments become visible, in commit order rather than id order
+        updates = {}
+        for post_id, likes, comment_count in (db.session.query(Post.id, Post.likes, Post.comment_count)
+                                              .filter(Post.id.in_(post_ids))):
+            seen = self._seen.get(post_id)
+            event = {}
+            if seen is None or likes != seen[0]:
+                event['likes'] = likes
+            recent = seen[2] if seen else None
+            if seen is None or comment_count != seen[1]:
+                added = max((comment_count or 0) - (seen[1] or 0), 0) if seen else 0
+                ids = [row.id for row in db.session.query(Comment.id).filter(Comment.post_id == post_id)
+                       .order_by(Comment.id.desc()).limit(self.COMMENT_LOOKBACK + added)]
+                if seen is not None and set(ids) - seen[2]:
+                    event['comments'] = sorted(set(ids) - seen[2])
+                recent = frozenset(ids)
+            updates[post_id] = ((likes, comment_count, recent), event)
+
+        with self._lock:
+            for post_id, (seen, event) in updates.items():
+                subscribers = self._subscribers.get(post_id)
+                if not subscribers:
+                    continue  # the last viewer left during the poll
+                self._seen[post_id] = seen
+                if not event:
+                    continue
+                message = f"event: update\ndata: {json.dumps(event)}\n\n"
+                for subscriber in subscribers:
+                    try:
+                        subscriber.put_nowait(message)
+                    except queue.Full:
+                        pass  # a stalled client only misses this tick's snapshot
+
+    def close_all(self):
+        """End every open stream; clients reconnect after their retry delay."""
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                for subscriber in subscribers:
+                    while True:
+                        try:
+                            subscriber.put_nowait(None)
+                            break
+                        except queue.Full:
+                            try:
+                                subscriber.get_nowait()
+                            except queue.Empty:
+                                pass
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                with app.app_context():
+                    self.poll()
+            except Exception:
+                app.logger.exception("Live update poll failed")
+            time.sleep(max(0.0, self.tick - (time.monotonic() - started)))
+
+live_updates = UpdateHub(app.config['UPDATES_TICK_MS'], app.config['UPDATES_MAX_SUBSCRIBERS'])
+
+@app.route('/post/<int:post_id>/events')
+def post_events(post_id):
+    if not is_logged_in():
+        abort(401)
+    get_post_or_404(post_id)
+    if draining.is_set():
+        # An empty stream: EventSource reconnects, through the load balancer, to a live worker
+        return Response("retry: 1000\n\n", mimetype='text/event-stream')
+    subscriber = live_updates.subscribe(post_id)
+    if subscriber is None:
+        # 204 tells EventSource to stop reconnecting; the page just goes without live updates
+        return Response(status=204)
+    keepalive = app.config['UPDATES_KEEPALIVE']
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    message = ": keepalive\n\n"
+                if message is None:
+                    return
+                yield message
+        finally:
+            live_updates.unsubscribe(post_id, subscriber)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+_job_lock = None
+
+def is_job_leader():
+    """True in the one process on this host that holds instance/jobs.lock.
+
+    Every worker tries for the lock before each run, so when the leader exits
+    another worker takes its jobs over.
+    """
+    global _job_lock
+    if _job_lock is None and fcntl is not None:
+        os.makedirs(app.instance_path, exist_ok=True)
+        lock = open(os.path.join(app.instance_path, 'jobs.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        _job_lock = lock
+    return True
+
+def start_periodic_job(name, interval, job):
+    """Run job() inside an app context every interval seconds on a daemon thread of the job leader."""
+    def run():
+        while True:
+            time.sleep(interval)
+            if not is_job_leader():
+                continue
+            with app.app_context():
+                try:
+                    job()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Background job %s failed", name)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+def start_background_jobs():
+    if app.config['LIKE_RECONCILE_INTERVAL']:
+        start_periodic_job('like-reconciler', app.config['LIKE_RECONCILE_INTERVAL'], reconcile_likes_job)
+    if app.config['HOT_REFRESH_INTERVAL']:
+        start_periodic_job('hot-score-refresher', app.config['HOT_REFRESH_INTERVAL'], refresh_hot_scores)
+    if app.config['POST_SOFT_DELETE'] and app.config['POST_PURGE_INTERVAL']:
+        start_periodic_job('post-purger', app.config['POST_PURGE_INTERVAL'], purge_deleted_posts)
+
+def reconcile_likes_job():
+    drifted = reconcile_like_counts()
+    if drifted:
+        app.logger.warning("Reconciled like counts for %d posts", len(drifted))
+
+@app.cli.command('reconcile-likes')
+def reconcile_likes_command():
+    """Rebuild Post.likes from the Like table."""
+    print(f"Reconciled {len(reconcile_like_counts())} posts")
+
+@app.cli.command('refresh-hot-scores')
+@click.option('--days', type=int, default=None, help='Recompute posts from this many days back (default HOT_REFRESH_WINDOW_DAYS).')
+def refresh_hot_scores_command(days):
+    """Recompute materialized hot scores."""
+    print(f"Refreshed {refresh_hot_scores(days)} posts")
+
+@app.cli.command('reconcile-threads')
+def reconcile_threads_command():
+    """Repair denormalized comment counts and thread activity times."""
+    posts, comments = reconcile_thread_counts()
+    print(f"Repaired {posts} posts and {comments} comments")
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create missing tables, columns and indexes and rebuild the values derived from them."""
+    added = migrate_schema()
+    print(f"Added {len(added)} columns" + (f": {', '.join(added)}" if added else ""))
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Remove soft-deleted posts with their comments and likes."""
+    print(f"Purged {len(purge_deleted_posts())} posts")
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the full-text search index from the post and comment tables."""
+    if not search_available():
+        print("Full-text search needs SQLite FTS5; other databases use a LIKE fallback")
+        return
+    db.create_all()
+    rebuild_search_index()
+    print("Search index rebuilt")
+
+# Bulk transfer: tables are copied in id order with keyset pagination, so memory
+# stays at one batch of rows however large they are, and progress is a row id that
+# a checkpoint file can record. Parents come before children to satisfy foreign keys.
+TRANSFER_MODELS = (User, Post, Comment, Like)
+
+def iter_row_batches(model, after_id=0, where=None, session=None, batch_size=None):
+    """Yield lists of row dicts with ids above after_id, TRANSFER_BATCH_SIZE rows at a time."""
+    session = session or db.session
+    batch_size = batch_size or app.config['TRANSFER_BATCH_SIZE']
+    table = model.__table__
+    while True:
+        query = db.select(table).where(table.c.id > after_id)
+        if where is not None:
+            query = query.where(where)
+        rows = session.execute(query.order_by(table.c.id).limit(batch_size)).mappings().all()
+        if not rows:
+            return
+        after_id = rows[-1]['id']
+        yield [dict(row) for row in rows]
+
+def insert_ignoring_duplicates(model, dialect):
+    """INSERT that skips rows whose key is already there, so replaying a batch after a crash is harmless."""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(model.__table__).on_conflict_do_nothing()
+    return db.insert(model.__table__).prefix_with('IGNORE' if dialect == 'mysql' else 'OR IGNORE')
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_checkpoint(path, state):
+    # Written aside and renamed so a crash never leaves a half-written checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def export_tables(directory, chunk_rows=None):
+    """Write every table to gzipped NDJSON chunk files, resuming from directory/export-checkpoint.json.
+
+    A chunk file only gets its final name once complete, and the checkpoint
+    then records the last exported id, so an interrupted export continues with
+    the next chunk. Rows are not read in one transaction: rows written while the
+    export runs may or may not be included.
+    """
+    chunk_rows = chunk_rows or app.config['EXPORT_CHUNK_ROWS']
+    batch_size = min(chunk_rows, app.config['TRANSFER_BATCH_SIZE'])
+    os.makedirs(directory, exist_ok=True)
+    checkpoint_path = os.path.join(directory, 'export-checkpoint.json')
+    state = load_checkpoint(checkpoint_path)
+    for model in TRANSFER_MODELS:
+        progress = state.setdefault(model.__tablename__, {'last_id': 0, 'chunks': 0, 'rows': 0, 'done': False})
+        while not progress['done']:
+            path = os.path.join(directory, f"{model.__tablename__}-{progress['chunks'] + 1:06d}.ndjson.gz")
+            rows, last_id = 0, progress['last_id']
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                for batch in iter_row_batches(model, last_id, batch_size=batch_size):
+                    f.writelines(json.dumps(row, default=api_default, ensure_ascii=False) + '\n' for row in batch)
+                    rows, last_id = rows + len(batch), batch[-1]['id']
+                    if rows >= chunk_rows:
+                        break
+            if rows:
+                os.replace(path + '.tmp', path)
+                progress.update(last_id=last_id, chunks=progress['chunks'] + 1, rows=progress['rows'] + rows)
+            else:
+                os.remove(path + '.tmp')
+                progress['done'] = True
+            save_checkpoint(checkpoint_path, state)
+    return {name: progress['rows'] for name, progress in state.items()}
+
+def import_tables(directory):
+    """Insert the chunk files written by export_tables with batched executemany.
+
+    Each file is committed as a whole and then listed in
+    directory/import-checkpoint.json; rows whose id already exists are skipped,
+    so a file cut off halfway is simply imported again.
+    """
+    batch_size = app.config['TRANSFER_BATCH_SIZE']
+    checkpoint_path = os.path.join(directory, 'import-checkpoint.json')
+    state = load_checkpoint(checkpoint_path)
+    done = set(state.get('files', []))
+    imported = {}
+    for model in TRANSFER_MODELS:
+        columns = set(model.__table__.columns.keys())
+        datetimes = {column.name for column in model.__table__.columns if isinstance(column.type, db.DateTime)}
+        statement = insert_ignoring_duplicates(model, db.engine.dialect.name)
+        prefix = model.__tablename__ + '-'
+        for filename in sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith('.ndjson.gz')):
+            if filename in done:
+                continue
+            rows = 0
+            with gzip.open(os.path.join(directory, filename), 'rt', encoding='utf-8') as f:
+                batch = []
+                for line in f:
+                    row = {key: value for key, value in json.loads(line).items() if key in columns}
+                    for key in datetimes & row.keys():
+                        if row[key] is not None:
+                            row[key] = datetime.fromisoformat(row[key])
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        db.session.execute(statement, batch)
+                        rows, batch = rows + len(batch), []
+                if batch:
+                    db.session.execute(statement, batch)
+                    rows += len(batch)
+            db.session.commit()
+            done.add(filename)
+            state['files'] = sorted(done)
+            save_checkpoint(checkpoint_path, state)
+            imported[model.__tablename__] = imported.get(model.__tablename__, 0) + rows
+    return imported
+
+def archive_threads(days, batch_size=100):
+    """Move threads without activity for `days` days into the archive file; returns how many moved.
+
+    Every batch of posts is copied with its comments and likes and committed to
+    the archive before it is deleted here, and copies skip rows already in the
+    archive, so an interrupted run just picks up the remaining threads when it
+    is started again.
+    """
+    path = app.config['ARCHIVE_PATH']
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    engine = archive_engine(path, readonly=False)
+    db.metadata.create_all(engine, tables=[Post.__table__, Comment.__table__, Like.__table__])
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    while True:
+        post_ids = [row.id for row in db.session.query(Post.id).filter(
+            Post.deleted_at.is_(None), db.func.coalesce(Post.last_activity_at, Post.created_at) < cutoff
+        ).order_by(Post.id).limit(batch_size)]
+        if not post_ids:
+            return moved
+        with engine.begin() as archive:
+            for model, key in ((Post, Post.id), (Comment, Comment.post_id), (Like, Like.post_id)):
+                statement = insert_ignoring_duplicates(model, 'sqlite')
+                for rows in iter_row_batches(model, where=key.in_(post_ids)):
+                    archive.execute(statement, rows)
+        for post_id in post_ids:
+            unindex_post(post_id)
+            delete_post_rows(post_id)
+        db.session.commit()
+        moved += len(post_ids)
+
+@app.cli.command('export-data')
+@click.argument('directory')
+@click.option('--chunk-rows', type=int, default=None, help='Rows per chunk file (default EXPORT_CHUNK_ROWS).')
+def export_data_command(directory, chunk_rows):
+    """Export users, posts, comments and likes as gzipped NDJSON chunks; rerun to resume."""
+    for table, rows in export_tables(directory, chunk_rows).items():
+        print(f"{table}: {rows} rows")
+
+@app.cli.command('import-data')
+@click.argument('directory')
+def import_data_command(directory):
+    """Import chunks written by export-data; rerun to resume."""
+    db.create_all()
+    imported = import_tables(directory)
+    for table, rows in imported.items():
+        print(f"{table}: {rows} rows")
+    if imported and search_available():
+        rebuild_search_index()
+        print("Search index rebuilt")
+
+@app.cli.command('archive-threads')
+@click.option('--days', type=int, required=True, help='Archive threads with no activity for this many days.')
+@click.option('--batch-size', type=int, default=100, help='Threads moved per transaction.')
+def archive_threads_command(days, batch_size):
+    """Move idle threads into the read-only archive file (ARCHIVE_PATH)."""
+    print(f"Archived {archive_threads(days, batch_size)} threads to {app.config['ARCHIVE_PATH']}")
+
+# Versioned read API: flat JSON (or msgpack) records instead of HTML, with field
+# selection and the same cursors and validators as the pages
+API_POST_FIELDS = ('id', 'title', 'content', 'author', 'created_at', 'likes', 'liked', 'comment_count', 'last_activity_at')
+API_COMMENT_FIELDS = ('id', 'parent_id', 'author', 'content', 'created_at', 'reply_count')
+
+def api_format():
+    if request.args.get('format') == 'msgpack':
+        return 'msgpack'
+    return 'msgpack' if request.accept_mimetypes.best_match(['application/json', 'application/msgpack']) == 'application/msgpack' else 'json'
+
+def api_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def api_response(payload, status=200):
+    """Encode an API payload as msgpack when asked for (and installed), else as compact JSON."""
+    if api_format() == 'msgpack':
+        if msgpack is not None:
+            response = Response(msgpack.packb(payload, default=api_default), status=status, mimetype='application/msgpack')
+            response.vary.add('Accept')
+            return response
+        payload, status = {"success": False, "error": "Формат msgpack не поддерживается"}, 406
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, default=api_default, ensure_ascii=False, separators=(',', ':'))
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept')
+    return response
+
+def api_error(message, status):
+    return api_response({"success": False, "error": message}, status)
+
+def api_fields(allowed):
+    """Fields requested with ?fields=a,b (all by default); None if any is unknown."""
+    requested = request.args.get('fields')
+    if not requested:
+        return allowed
+    fields = tuple(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    return fields if fields and set(fields) <= set(allowed) else None
+
+def api_post(post, liked, fields):
+    return {name: liked if name == 'liked' else getattr(post, name) for name in fields}
+
+def api_live_post(post_id):
+    return Post.query.filter_by(id=post_id, deleted_at=None).first()
+
+@app.route('/api/v1/feed')
+def api_feed():
+    if not is_logged_in():
+        return api_error("Необходимо войти", 401)
+    fields = api_fields(API_POST_FIELDS)
+    if fields is None:
+        return api_error("Неизвестное поле", 400)
+    sort, window = get_feed_args()
+    parts, last_modified = feed_validators(sort, window)
+    return conditional_response(last_modified, lambda: api_feed_body(sort, window, fields), *parts, api_format())
+
+def api_feed_body(sort, window, fields):
+    posts, next_cursor = get_feed_page(request.args.get('cursor'), request.args.get('limit', type=int), sort, window)
+    liked_ids = get_liked_post_ids(post.id for post in posts) if 'liked' in fields else set()
+    return api_response({"success": True, "posts": [api_post(post, post.id in liked_ids, fields) for post in posts],
+                         "next_cursor": next_cursor})
+
+@app.route('/api/v1/posts/<int:post_id>')
+def api_get_post(post_id):
+    if not is_logged_in():
+        return api_error("Необходимо войти", 401)
+    fields = api_fields(API_POST_FIELDS)
+    if fields is None:
+        return api_error("Неизвестное поле", 400)
+    post = api_live_post(post_id)
+    if post is None:
+        return api_error("Пост не найден", 404)
+    return conditional_response(post.changed_at, lambda: api_response({
+        "success": True, "post": api_post(post, 'liked' in fields and user_liked_post(post.id), fields)}),
+        post.changed_at, api_format())
+
+@app.route('/api/v1/posts/<int:post_id>/comments')
+def api_get_comments(post_id):
+    """A post's comments as a flat list in creation order; clients rebuild the tree from parent_id."""
+    if not is_logged_in():
+        return api_error("Необходимо войти", 401)
+    fields = api_fields(API_COMMENT_FIELDS)
+    if fields is None:
+        return api_error("Неизвестное поле", 400)
+    post = api_live_post(post_id)
+    if post is None:
+        return api_error("Пост не найден", 404)
+    return conditional_response(post.changed_at, lambda: api_comments_body(post_id, fields), post.changed_at, api_format())
+
+def api_comments_body(post_id, fields):
+    limit = request.args.get('limit', app.config['API_COMMENT_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['API_COMMENT_MAX_PAGE_SIZE']))
+    after = request.args.get('cursor', 0, type=int)
+    columns = [getattr(Comment, name) for name in dict.fromkeys(('id',) + fields)]
+    rows = db.session.execute(db.select(*columns).where(Comment.post_id == post_id, Comment.id > after)
+                              .order_by(Comment.id).limit(limit + 1)).all()
+    next_cursor = str(rows[limit - 1].id) if len(rows) > limit else None
+    return api_response({"success": True, "comments": [{name: getattr(row, name) for name in fields} for row in rows[:limit]],
+                         "next_cursor": next_cursor})
+
+def require_internal_access():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    else:
+        try:
+            address = ipaddress.ip_address(request.remote_addr or '')
+            allowed = address.is_loopback
+        except ValueError:
+            allowed = False
+    if not allowed:
+        abort(403)
+
+@app.route('/cache/stats')
+@limiter.exempt
+def cache_stats():
+    require_internal_access()
+    return jsonify(fragment_cache.stats())
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics():
+    require_internal_access()
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Production entry point: gunicorn -c gunicorn.conf.py. The server imports the app
+# once, creates the schema, then forks workers that each call init_worker().
+draining = threading.Event()
+
+def migrate_schema():
+    """Bring an existing database up to the models; returns the columns it added.
+
+    create_all() only creates missing tables, so columns and indexes added to
+    existing tables since the database was created are added here, and the
+    values derived from other tables are then rebuilt by the reconcile jobs.
+    """
+    searchable = 'post_search' in db.inspect(db.engine).get_table_names()
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    added = []
+    with db.engine.begin() as connection:
+        preparer = connection.dialect.identifier_preparer
+        for table in db.metadata.sorted_tables:
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(connection.dialect)}"
+                # Existing rows take the scalar default; without one the column has to start out nullable
+                if column.default is not None and column.default.is_scalar:
+                    default = db.literal(column.default.arg, column.type).compile(connection, compile_kwargs={'literal_binds': True})
+                    ddl += f" DEFAULT {default}" + ("" if column.nullable else " NOT NULL")
+                connection.execute(text(ddl))
+                added.append(f"{table.name}.{column.name}")
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+    if added:
+        # Mark every post as changed so validators and cached fragments from before the upgrade expire
+        Post.query.filter(Post.changed_at.is_(None)).update({Post.changed_at: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        reconcile_thread_counts()
+        refresh_hot_scores()
+    if not searchable and search_available():
+        rebuild_search_index()
+    return added
+
+def prepare_database():
+    """Create or migrate the schema; run once before workers start, not in every worker."""
     with app.app_context():
-        db.create_all()
+        added = migrate_schema()
+        if added:
+            app.logger.warning("Added columns %s and rebuilt derived values", ", ".join(added))
+        # Connections opened here must not be shared with forked workers
+        for engine in db.engines.values():
+            engine.dispose()
+
+def create_app():
+    """WSGI application factory for pre-fork servers."""
+    prepare_database()
+    return app
+
+def begin_drain():
+    """Fail readiness checks and end live update streams so in-flight requests can finish."""
+    draining.set()
+    live_updates.close_all()
+
+def install_drain_handler(delay):
+    """On SIGTERM drain for `delay` seconds, then pass the signal on to the server's own handler."""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def stop(signum, frame):
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            # No handler to hand over to: exit through KeyboardInterrupt so atexit hooks still flush
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def handle(signum, frame):
+        if draining.is_set():
+            return
+        app.logger.info("SIGTERM received, draining for %ds", delay)
+        begin_drain()
+        threading.Timer(delay, stop, (signum, frame)).start()
+
+    signal.signal(signal.SIGTERM, handle)
+
+def init_worker():
+    """Per-process setup after fork: fresh connections, graceful drain and background jobs."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    install_drain_handler(app.config['DRAIN_SECONDS'])
+    start_background_jobs()
+
+@app.route('/healthz')
+@limiter.exempt
+def liveness():
+    return jsonify({"success": True, "status": "alive"})
+
+@app.route('/readyz')
+@limiter.exempt
+def readiness():
+    if draining.is_set():
+        return jsonify({"success": False, "status": "draining"}), 503
+    try:
+        for engine in db.engines.values():
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+    except Exception:
+        app.logger.exception("Readiness check failed")
+        return jsonify({"success": False, "status": "database unavailable"}), 503
+    return jsonify({"success": True, "status": "ready"})
+
+if __name__ == '__main__':
+    # Development server; production runs under gunicorn -c gunicorn.conf.py
+    prepare_database()
+    start_background_jobs()
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)), debug=True)
@@ -0,0 +1,217 @@
+function showNotification(message, type) {
+    const notification = document.createElement('div');
+    notification.className = `fixed top-4 right-4 p-4 rounded-md shadow-md ${type === 'success' ? 'bg-blue-500' : 'bg-red-500'} text-white`;
+    notification.textContent = message;
+    document.body.appendChild(notification);
+
+    setTimeout(() => {
+        notification.style.opacity = '0';
+        notification.style.transition = 'opacity 0.5s';
+        setTimeout(() => {
+            document.body.removeChild(notification);
+        }, 500);
+    }, 3000);
+}
+
+async function likePost(postId) {
+    try {
+        const response = await fetch(`/like/${postId}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest'
+            }
+        });
+        const data = await response.json();
+        if (data.success) {
+            const likeCount = document.getElementById(`like-count-${postId}`);
+            likeCount.textContent = data.likes;
+
+            const likeBtn = document.getElementById(`like-btn-${postId}`);
+            if (data.liked) {
+                likeBtn.innerHTML = '<i class="fas fa-heart text-blue-500"></i>';
+            } else {
+                likeBtn.innerHTML = '<i class="far fa-heart"></i>';
+            }
+        } else if (data.error === "Необходимо войти") {
+            window.location.href = "/login";
+        }
+    } catch (error) {
+        console.error('Error liking post:', error);
+    }
+}
+
+async function deletePost(postId) {
+    if (confirm('Вы уверены, что хотите удалить этот пост?')) {
+        try {
+            const response = await fetch(`/delete/${postId}`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-Requested-With': 'XMLHttpRequest'
+                }
+            });
+            const data = await response.json();
+            if (data.success) {
+                showNotification(data.message, 'success');
+                setTimeout(() => {
+                    window.location.href = data.redirect;
+                }, 1000);
+            } else {
+                showNotification(data.message, 'error');
+            }
+        } catch (error) {
+            console.error('Error deleting post:', error);
+        }
+    }
+}
+
+async function registerUser(event) {
+    event.preventDefault();
+    const form = event.target;
+    const formData = new FormData(form);
+    const response = await fetch(form.action, {
+        method: 'POST',
+        body: formData
+    });
+    const data = await response.json();
+    if (data.success) {
+        showNotification(data.message, 'success');
+        setTimeout(() => {
+            window.location.href = data.redirect;
+        }, 1000);
+    } else {
+        showNotification(data.message, 'error');
+    }
+}
+
+async function loginUser(event) {
+    event.preventDefault();
+    const form = event.target;
+    const formData = new FormData(form);
+    const response = await fetch(form.action, {
+        method: 'POST',
+        body: formData
+    });
+    const data = await response.json();
+    if (data.success) {
+        showNotification(data.message, 'success');
+        setTimeout(() => {
+            window.location.href = data.redirect;
+        }, 1000);
+    } else {
+        showNotification(data.message, 'error');
+    }
+}
+
+async function createPost(event) {
+    event.preventDefault();
+    const form = event.target;
+    const formData = new FormData(form);
+    const response = await fetch(form.action, {
+        method: 'POST',
+        body: formData
+    });
+    const data = await response.json();
+    if (data.success) {
+        showNotification(data.message, 'success');
+        setTimeout(() => {
+            window.location.href = data.redirect;
+        }, 1000);
+    } else {
+        showNotification(data.message, 'error');
+    }
+}
+
+let loadingMorePosts = false;
+
+async function loadMorePosts() {
+    const loadMore = document.getElementById('load-more');
+    if (!loadMore || loadingMorePosts) {
+        return;
+    }
+    loadingMorePosts = true;
+    try {
+        const params = new URLSearchParams({
+            cursor: loadMore.dataset.cursor,
+            sort: loadMore.dataset.sort,
+            t: loadMore.dataset.window
+        });
+        const response = await fetch(`/feed.json?${params}`, {
+            headers: {'X-Requested-With': 'XMLHttpRequest'}
+        });
+        const data = await response.json();
+        loadMore.insertAdjacentHTML('beforebegin', data.html);
+        if (data.next_cursor) {
+            loadMore.dataset.cursor = data.next_cursor;
+        } else {
+            loadMore.remove();
+        }
+    } catch (error) {
+        console.error('Error loading posts:', error);
+    }
+    loadingMorePosts = false;
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    const loadMore = document.getElementById('load-more');
+    if (loadMore && 'IntersectionObserver' in window) {
+        new IntersectionObserver(function(entries) {
+            if (entries[0].isIntersecting) {
+                loadMorePosts();
+            }
+        }).observe(loadMore);
+    }
+});
+
+async function loadThread(link) {
+    try {
+        const response = await fetch(link.href, {
+            headers: {'X-Requested-With': 'XMLHttpRequest'}
+        });
+        const container = link.parentElement;
+        container.insertAdjacentHTML('beforebegin', await response.text());
+        container.remove();
+    } catch (error) {
+        console.error('Error loading thread:', error);
+    }
+}
+
+function subscribePost(postId) {
+    if (!window.EventSource) {
+        return;
+    }
+    // Comments already on the page are not announced again. Ids are kept as a
+    // set: a comment can commit after one with a higher id was announced
+    const seen = new Set();
+    document.querySelectorAll('[id^="comment-"]').forEach((el) => {
+        const id = parseInt(el.id.slice(8), 10);
+        if (id) {
+            seen.add(id);
+        }
+    });
+    let newComments = 0;
+    const source = new EventSource(`/post/${postId}/events`);
+    source.addEventListener('update', (event) => {
+        const data = JSON.parse(event.data);
+        if (data.likes !== undefined) {
+            const likeCount = document.getElementById(`like-count-${postId}`);
+            if (likeCount) {
+                likeCount.textContent = data.likes;
+            }
+        }
+        const fresh = (data.comments || []).filter((id) => !seen.has(id));
+        if (fresh.length) {
+            fresh.forEach((id) => seen.add(id));
+            newComments += fresh.length;
+            const notice = document.getElementById('new-comments');
+            notice.textContent = `Новые комментарии: ${newComments} — обновить`;
+            notice.classList.remove('hidden');
+        }
+    });
+}
+
+function toggleReplyForm(commentId) {
+    const replyForm = document.getElementById(`reply-form-${commentId}`);
+    replyForm.classList.toggle('hidden');
+}